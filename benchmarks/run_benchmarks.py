@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# замеры TransportAccessibilityIsochrones и ParkingDeficitAnalyzer на синтетических городах
+# разного размера без графического интерфейса.
+# каждый прогон - отдельный процесс (своя пиковая память): либо этот же скрипт
+# с QgsApplication (--engine app), либо qgis_process (--engine qgis_process).
+#
+#   python benchmarks/run_benchmarks.py --sizes 1000,10000,100000,1000000 --save-baseline
+#   python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# алгоритм -> (файл скрипта, класс, параметры от путей синтетического города)
+ALGORITHMS = {
+    'isochrones': (os.path.join(ROOT, 'task1', 'main1.py'), 'TransportAccessibilityIsochrones', lambda p: {
+        'INPUT_STOPS_IN': p['stops_in'],
+        'INPUT_STOPS_OUT': p['stops_out'],
+        'INPUT_GRAPH': p['graph'],
+        'INPUT_CONTOURS': p['contours'],
+        'CONTOUR_FIELD': 'ELEV',
+        'INPUT_BUILDINGS': p['buildings'],
+        'POPULATION_FIELD': 'pop',
+        'MAX_COST': 500,
+        'USE_RELIEF': True,
+        # замеряется полная подготовка графа, без кэша
+        'USE_CACHE': False,
+        'OUTPUT_LAYER_IN': 'TEMPORARY_OUTPUT',
+        'OUTPUT_LAYER_OUT': 'TEMPORARY_OUTPUT',
+        'OUTPUT_INTERSECTION': 'TEMPORARY_OUTPUT',
+    }),
+    'parking_deficit': (os.path.join(ROOT, 'task6', 'modul.py'), 'ParkingDeficitAnalyzer', lambda p: {
+        'INPUT_GRID': p['grid'],
+        'INPUT_PARKING': p['parking'],
+        'INPUT_BUILDINGS': p['buildings'],
+        'FIELD_CAPACITY': 'capacity',
+        'FIELD_POPULATION': 'pop',
+        'FIELD_RATIO': 2.0,
+        'OUTPUT_LAYER': 'TEMPORARY_OUTPUT',
+    }),
+}
+
+
+def parse_list(text, cast):
+    return [cast(token) for token in text.replace(';', ',').split(',') if token.strip()]
+
+
+def city_paths(data_dir, edges, seed):
+    # слои синтетического города; генерируются один раз и переиспользуются между запусками
+    out_dir = os.path.join(data_dir, f'city_{edges}_{seed}')
+    meta_path = os.path.join(out_dir, 'city.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    from osgeo import gdal
+    from synthetic_city import generate
+    gdal.UseExceptions()
+    started = time.perf_counter()
+    paths, counts = generate(out_dir, edges, seed)
+    meta = {'paths': paths, 'counts': counts, 'generate_seconds': time.perf_counter() - started}
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def start_qgis():
+    # qgis без интерфейса и провайдеры processing
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    return app
+
+
+def load_algorithm(script, class_name):
+    # скрипты обработки самостоятельны - загружаются по пути, как их загружает qgis
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(script))[0], script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)().create()
+
+
+def worker(algorithm, params_path):
+    # один прогон в этом процессе; время - без запуска qgis
+    app = start_qgis()
+    import processing
+    from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+    script, class_name, _ = ALGORITHMS[algorithm]
+    with open(params_path, encoding='utf-8') as f:
+        params = json.load(f)
+    alg = load_algorithm(script, class_name)
+    context, feedback = QgsProcessingContext(), QgsProcessingFeedback()
+    started = time.perf_counter()
+    processing.run(alg, params, context=context, feedback=feedback)
+    seconds = time.perf_counter() - started
+    print('BENCHMARK ' + json.dumps({'seconds': seconds}))
+    sys.stdout.flush()
+    app.exitQgis()
+
+
+def qgis_process_args(script, params):
+    args = [os.environ.get('QGIS_PROCESS', 'qgis_process'), 'run', script, '--']
+    for key, value in params.items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        args.append(f'{key}={value}')
+    return args
+
+
+def measure(args):
+    # процесс прогона: время по часам, пиковая память по rusage именно этого процесса (linux: ru_maxrss в кб)
+    started = time.perf_counter()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    out = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - started
+    if proc.returncode:
+        raise RuntimeError(f"прогон {' '.join(args[:4])} завершился с кодом {proc.returncode}:\n{out[-2000:]}")
+    seconds = wall
+    for line in out.splitlines():
+        if line.startswith('BENCHMARK '):
+            seconds = json.loads(line[len('BENCHMARK '):])['seconds']
+    return seconds, wall, usage.ru_maxrss * 1024
+
+
+def run_suite(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    runs = []
+    for edges in args.sizes:
+        city = city_paths(args.data_dir, edges, args.seed)
+        print(f"город ~{edges} ребер: " + ', '.join(f'{k}={v}' for k, v in city['counts'].items()))
+        for algorithm in args.algorithms:
+            script, class_name, make_params = ALGORITHMS[algorithm]
+            params = make_params(city['paths'])
+            if args.engine == 'qgis_process':
+                cmd = qgis_process_args(script, params)
+            else:
+                params_path = os.path.join(args.data_dir, f'params_{algorithm}.json')
+                with open(params_path, 'w', encoding='utf-8') as f:
+                    json.dump(params, f)
+                cmd = [sys.executable, os.path.abspath(__file__), '--worker', algorithm, params_path]
+            samples = [measure(cmd) for _ in range(args.repeat)]
+            run = {'algorithm': algorithm, 'edges': edges, 'counts': city['counts'],
+                   'seconds': statistics.median(s[0] for s in samples),
+                   'samples': [s[0] for s in samples],
+                   'process_seconds': statistics.median(s[1] for s in samples),
+                   'peak_rss_bytes': max(s[2] for s in samples)}
+            runs.append(run)
+            print(f"  {algorithm}: {run['seconds']:.2f} с, пик памяти {run['peak_rss_bytes'] / 2 ** 20:.0f} МБ")
+    return runs
+
+
+def environment(engine):
+    commit = None
+    try:
+        commit = subprocess.run(['git', '-C', ROOT, 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'engine': engine, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def compare(runs, baseline_path, tolerance):
+    # сравнение с базовой линией: замедление больше tolerance - регрессия
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(r['algorithm'], r['edges']): r for r in json.load(f)['runs']}
+    regressions = 0
+    for run in runs:
+        base = baseline.get((run['algorithm'], run['edges']))
+        if not base:
+            continue
+        ratio = run['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        mark = 'РЕГРЕССИЯ' if ratio > 1 + tolerance else ''
+        regressions += bool(mark)
+        print(f"{run['algorithm']:>16} {run['edges']:>8}: {base['seconds']:.2f} -> {run['seconds']:.2f} с "
+              f"(x{ratio:.2f}) {mark}")
+    return regressions
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--worker':
+        return worker(sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(description='Замеры алгоритмов на синтетических городах')
+    parser.add_argument('--sizes', type=lambda s: parse_list(s, int), default=[1000, 10000, 100000, 1000000],
+                        help='примерное число ребер графа, через запятую')
+    parser.add_argument('--algorithms', type=lambda s: parse_list(s, str), default=list(ALGORITHMS))
+    parser.add_argument('--engine', choices=['app', 'qgis_process'], default='app')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'))
+    parser.add_argument('--output', help='файл результатов (по умолчанию benchmarks/results/<время>.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='сохранить результаты как базовую линию')
+    parser.add_argument('--compare', metavar='BASELINE', help='сравнить с базовой линией')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление, доля')
+    args = parser.parse_args()
+    unknown = set(args.algorithms) - set(ALGORITHMS)
+    if unknown:
+        parser.error(f"неизвестные алгоритмы: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, HERE)
+    result = {'environment': environment(args.engine), 'runs': run_suite(args)}
+    output = args.output or os.path.join(HERE, 'results', datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    for path in [output] + ([BASELINE] if args.save_baseline else []):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"результаты: {path}")
+    if args.compare:
+        sys.exit(1 if compare(result['runs'], args.compare, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# генератор синтетического города для замеров:
+# пешеходный граф (решетка улиц со случайным сдвигом узлов), цмр и изолинии,
+# здания с населением, остановки (вход/выезд), парковки и регулярная сетка
+
+import argparse
+import math
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+# метрическая crs (utm 48n, иркутск)
+EPSG = 32648
+ORIGIN_X, ORIGIN_Y = 420000.0, 5790000.0
+# шаг решетки улиц, м
+BLOCK = 100.0
+# шаг цмр и изолиний, м
+DEM_CELL = 10.0
+CONTOUR_STEP = 2.0
+# ячейка сетки для анализа парковок, м
+GRID_CELL = 250.0
+# объектов в одной транзакции записи
+CHUNK = 20000
+
+
+def lattice_size(edges):
+    # число узлов по стороне решетки n x n, у которой 2n(n-1) ребер - ближайшее к заданному
+    return max(2, int(round((1 + math.sqrt(1 + 2 * edges)) / 2)))
+
+
+def spatial_ref():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def create_layer(path, name, geom_type, fields):
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    ds = driver.CreateDataSource(path)
+    layer = ds.CreateLayer(name, spatial_ref(), geom_type)
+    for field_name, field_type in fields:
+        layer.CreateField(ogr.FieldDefn(field_name, field_type))
+    return ds, layer
+
+
+def write_features(ds, layer, rows):
+    # rows - (wkt, {поле: значение}); запись пачками в транзакциях
+    defn = layer.GetLayerDefn()
+    ds.StartTransaction()
+    for i, (wkt, attrs) in enumerate(rows, 1):
+        f = ogr.Feature(defn)
+        f.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        for key, value in attrs.items():
+            f.SetField(key, value)
+        layer.CreateFeature(f)
+        if i % CHUNK == 0:
+            ds.CommitTransaction()
+            ds.StartTransaction()
+    ds.CommitTransaction()
+
+
+def elevation(x, y, size):
+    # рельеф: общий уклон и несколько холмов
+    u, v = (x - ORIGIN_X) / size, (y - ORIGIN_Y) / size
+    return (20 * u + 10 * v + 15 * np.sin(3 * math.pi * u) * np.cos(2 * math.pi * v)
+            + 8 * np.sin(7 * math.pi * v + 1.3))
+
+
+def generate(out_dir, edges, seed=0):
+    # все слои города с графом примерно из edges ребер; возвращает пути и число объектов
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    n = lattice_size(edges)
+    size = (n - 1) * BLOCK
+    jitter = rng.uniform(-0.2 * BLOCK, 0.2 * BLOCK, size=(n, n, 2))
+    nx = ORIGIN_X + np.arange(n)[None, :] * BLOCK + jitter[:, :, 0]
+    ny = ORIGIN_Y + np.arange(n)[:, None] * BLOCK + jitter[:, :, 1]
+    paths, counts = {}, {}
+
+    # граф: ребра решетки по строкам и столбцам
+    paths['graph'] = os.path.join(out_dir, 'graph.gpkg')
+    ds, layer = create_layer(paths['graph'], 'graph', ogr.wkbLineString, [])
+    def graph_rows():
+        for r in range(n):
+            for c in range(n):
+                if c + 1 < n:
+                    yield f'LINESTRING ({nx[r, c]} {ny[r, c]}, {nx[r, c + 1]} {ny[r, c + 1]})', {}
+                if r + 1 < n:
+                    yield f'LINESTRING ({nx[r, c]} {ny[r, c]}, {nx[r + 1, c]} {ny[r + 1, c]})', {}
+    write_features(ds, layer, graph_rows())
+    counts['edges'] = 2 * n * (n - 1)
+    ds = None
+
+    # цмр и изолинии из нее
+    cells = int(math.ceil(size / DEM_CELL)) + 1
+    xs = ORIGIN_X - BLOCK + (np.arange(cells + 20) + 0.5) * DEM_CELL
+    ys = ORIGIN_Y + size + BLOCK - (np.arange(cells + 20) + 0.5) * DEM_CELL
+    dem = elevation(xs[None, :], ys[:, None], size).astype(np.float32)
+    paths['dem'] = os.path.join(out_dir, 'dem.tif')
+    raster = gdal.GetDriverByName('GTiff').Create(paths['dem'], dem.shape[1], dem.shape[0], 1, gdal.GDT_Float32,
+                                                  options=['COMPRESS=DEFLATE', 'TILED=YES'])
+    raster.SetGeoTransform((ORIGIN_X - BLOCK, DEM_CELL, 0, ORIGIN_Y + size + BLOCK, 0, -DEM_CELL))
+    raster.SetProjection(spatial_ref().ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(dem)
+
+    paths['contours'] = os.path.join(out_dir, 'contours.gpkg')
+    ds, layer = create_layer(paths['contours'], 'contours', ogr.wkbLineString,
+                             [('id', ogr.OFTInteger), ('ELEV', ogr.OFTReal)])
+    ds.StartTransaction()
+    gdal.ContourGenerate(raster.GetRasterBand(1), CONTOUR_STEP, 0, [], 0, 0, layer, 0, 1)
+    ds.CommitTransaction()
+    counts['contours'] = layer.GetFeatureCount()
+    ds = raster = None
+
+    # здания: по одному в квартале, население пропорционально площади
+    paths['buildings'] = os.path.join(out_dir, 'buildings.gpkg')
+    ds, layer = create_layer(paths['buildings'], 'buildings', ogr.wkbPolygon, [('pop', ogr.OFTInteger)])
+    cx = ORIGIN_X + (np.arange(n - 1) + 0.5) * BLOCK
+    cy = ORIGIN_Y + (np.arange(n - 1) + 0.5) * BLOCK
+    half = rng.uniform(10, 30, size=(n - 1, n - 1))
+    pop = np.rint(half * half * rng.uniform(0.05, 0.25, size=half.shape)).astype(int)
+    def building_rows():
+        for r in range(n - 1):
+            for c in range(n - 1):
+                x0, y0, h = cx[c] - half[r, c], cy[r] - half[r, c], 2 * half[r, c]
+                yield (f'POLYGON (({x0} {y0}, {x0 + h} {y0}, {x0 + h} {y0 + h}, {x0} {y0 + h}, {x0} {y0}))',
+                       {'pop': int(pop[r, c])})
+    write_features(ds, layer, building_rows())
+    counts['buildings'] = (n - 1) ** 2
+    ds = None
+
+    # остановки: случайные узлы графа, поровну на вход и выезд
+    stops = max(4, counts['edges'] // 2000)
+    picked = rng.choice(n * n, size=min(2 * stops, n * n), replace=False)
+    for key, part in (('stops_in', picked[0::2]), ('stops_out', picked[1::2])):
+        paths[key] = os.path.join(out_dir, f'{key}.gpkg')
+        ds, layer = create_layer(paths[key], key, ogr.wkbPoint, [])
+        write_features(ds, layer, ((f'POINT ({nx.flat[i]} {ny.flat[i]})', {}) for i in part))
+        counts[key] = len(part)
+        ds = None
+
+    # парковки: точки у улиц с вместимостью
+    parking = max(10, (n - 1) ** 2 // 4)
+    px = ORIGIN_X + rng.uniform(0, size, parking)
+    py = ORIGIN_Y + rng.uniform(0, size, parking)
+    capacity = rng.integers(5, 120, parking)
+    paths['parking'] = os.path.join(out_dir, 'parking.gpkg')
+    ds, layer = create_layer(paths['parking'], 'parking', ogr.wkbPoint, [('capacity', ogr.OFTInteger)])
+    write_features(ds, layer, ((f'POINT ({x} {y})', {'capacity': int(v)}) for x, y, v in zip(px, py, capacity)))
+    counts['parking'] = parking
+    ds = None
+
+    # регулярная сетка, покрывающая город
+    side = int(math.ceil(size / GRID_CELL)) or 1
+    paths['grid'] = os.path.join(out_dir, 'grid.gpkg')
+    ds, layer = create_layer(paths['grid'], 'grid', ogr.wkbPolygon, [('id', ogr.OFTInteger)])
+    def grid_rows():
+        for r in range(side):
+            for c in range(side):
+                x0, y0 = ORIGIN_X + c * GRID_CELL, ORIGIN_Y + r * GRID_CELL
+                x1, y1 = x0 + GRID_CELL, y0 + GRID_CELL
+                yield (f'POLYGON (({x0} {y0}, {x1} {y0}, {x1} {y1}, {x0} {y1}, {x0} {y0}))',
+                       {'id': r * side + c})
+    write_features(ds, layer, grid_rows())
+    counts['grid'] = side * side
+    ds = None
+    return paths, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетический город для замеров')
+    parser.add_argument('out_dir')
+    parser.add_argument('--edges', type=int, default=10000, help='примерное число ребер графа')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    gdal.UseExceptions()
+    _, counts = generate(args.out_dir, args.edges, args.seed)
+    print(', '.join(f'{key}: {value}' for key, value in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
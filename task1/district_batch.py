@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsProcessing,
+                       QgsFeatureSink,
+                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingException,
+                       QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsVectorLayer,
+                       QgsWkbTypes,
+                       QgsFeatureRequest,
+                       QgsCoordinateTransform,
+                       QgsProviderRegistry,
+                       QgsVectorFileWriter)
+
+import importlib.util
+import os
+
+
+def load_script(file_name):
+    # общий код берется из соседнего скрипта по пути, как его загружает qgis;
+    # классы оттуда не импортируются по имени: поставщик скриптов регистрирует
+    # первый найденный в модуле класс алгоритма
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(file_name)[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+main1 = load_script('main1.py')
+
+
+def gpkg_writer(path, layer_name, fields, wkb_type, crs, transform_context, new_file):
+    # слой geopackage для записи: первый слой создает файл, остальные добавляются в него
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = layer_name
+    options.actionOnExistingFile = (QgsVectorFileWriter.CreateOrOverwriteFile if new_file
+                                    else QgsVectorFileWriter.CreateOrOverwriteLayer)
+    writer = QgsVectorFileWriter.create(path, fields, wkb_type, crs, transform_context, options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise QgsProcessingException(f"ошибка записи {layer_name}: {writer.errorMessage()}")
+    return writer
+
+
+class DistrictBatchIsochrones(main1.TransportAccessibilityIsochrones):
+    # пакетный расчет: граф, рельеф и индекс зданий готовятся один раз,
+    # районы из таблицы (название и пути к слоям остановок входа/выезда) считаются параллельно,
+    # все зоны и итоги по населению пишутся в один geopackage
+    INPUT_DISTRICTS = 'INPUT_DISTRICTS'
+    DISTRICT_FIELD = 'DISTRICT_FIELD'
+    STOPS_IN_FIELD = 'STOPS_IN_FIELD'
+    STOPS_OUT_FIELD = 'STOPS_OUT_FIELD'
+    OUTPUT_GPKG = 'OUTPUT_GPKG'
+
+    # слои результата: индекс зоны в (порог, вход, выход, пересечение) -> имя слоя
+    ZONE_LAYERS = ((1, 'zones_in'), (2, 'zones_out'), (3, 'zones_full'))
+
+    def createInstance(self):
+        return DistrictBatchIsochrones()
+
+    def name(self):
+        return 'transport_accessibility_district_batch'
+
+    def displayName(self):
+        return self.tr('Хакатон: Изохроны по районам (пакетный расчет)')
+
+    def initAlgorithm(self, config=None):
+        # таблица районов: название и пути к слоям остановок (относительные - от папки таблицы)
+        self.addParameter(QgsProcessingParameterVectorLayer(
+            self.INPUT_DISTRICTS, self.tr('Таблица районов'), [QgsProcessing.TypeVector]))
+        self.addParameter(QgsProcessingParameterField(
+            self.DISTRICT_FIELD, self.tr('Поле названия района'), parentLayerParameterName=self.INPUT_DISTRICTS))
+        self.addParameter(QgsProcessingParameterField(
+            self.STOPS_IN_FIELD, self.tr('Поле пути к остановкам (вход в район)'), parentLayerParameterName=self.INPUT_DISTRICTS,
+            type=QgsProcessingParameterField.String))
+        self.addParameter(QgsProcessingParameterField(
+            self.STOPS_OUT_FIELD, self.tr('Поле пути к остановкам (выезд из района)'), parentLayerParameterName=self.INPUT_DISTRICTS,
+            type=QgsProcessingParameterField.String))
+
+        self.add_network_parameters()
+
+        # все районы в одном geopackage: zones_in, zones_out, zones_full и таблица population
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.OUTPUT_GPKG, self.tr('Результат (GeoPackage)'), self.tr('GeoPackage (*.gpkg)')))
+
+        self.add_profile_parameter()
+
+    def district_stops(self, parameters, context, w_crs):
+        # координаты остановок всех районов в crs графа (слои читаются в основном потоке)
+        table = self.parameterAsVectorLayer(parameters, self.INPUT_DISTRICTS, context)
+        name_field = self.parameterAsString(parameters, self.DISTRICT_FIELD, context)
+        in_field = self.parameterAsString(parameters, self.STOPS_IN_FIELD, context)
+        out_field = self.parameterAsString(parameters, self.STOPS_OUT_FIELD, context)
+        table_path = QgsProviderRegistry.instance().decodeUri(table.providerType(), table.source()).get('path')
+        base_dir = os.path.dirname(table_path) if table_path else os.getcwd()
+
+        def stops_xy(uri, label):
+            path, sep, options = (uri or '').strip().partition('|')
+            if not path:
+                raise QgsProcessingException(f"ошибка: не указан слой остановок ({label}).")
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            layer = QgsVectorLayer(path + sep + options, label, 'ogr')
+            if not layer.isValid():
+                raise QgsProcessingException(f"ошибка загрузки слоя остановок: {path}")
+            to_graph = QgsCoordinateTransform(layer.crs(), w_crs, context.transformContext())
+            xy = main1.point_xy(layer.getFeatures(), to_graph)
+            if not len(xy[0]):
+                raise QgsProcessingException(f"ошибка: в слое {path} нет остановок.")
+            return xy
+
+        districts = []
+        for f in table.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)):
+            name = str(f[name_field])
+            districts.append((name, stops_xy(f[in_field], f"{name} вход"), stops_xy(f[out_field], f"{name} выход")))
+        return districts
+
+    def processAlgorithm(self, parameters, context, feedback):
+        self.sidecar_arrays = {}
+        w_crs = self.parameterAsVectorLayer(parameters, self.INPUT_GRAPH, context).sourceCrs()
+        output_path = self.parameterAsFileOutput(parameters, self.OUTPUT_GPKG, context)
+        profile_path = self.parameterAsFileOutput(parameters, self.PROFILE_OUTPUT, context)
+        profiler = main1.StageProfiler(feedback)
+
+        with profiler.stage("остановки районов") as record:
+            districts = self.district_stops(parameters, context, w_crs)
+            record['features'] = len(districts)
+        if not districts:
+            raise QgsProcessingException("ошибка: таблица районов пуста.")
+
+        # общие для всех районов граф и индекс зданий
+        graph = self.load_graph(parameters, context, feedback, profiler)
+        if feedback.isCanceled():
+            return {}
+        pop_index = self.load_population(parameters, context, feedback, profiler, w_crs)
+        if feedback.isCanceled():
+            return {}
+        settings = self.zone_settings(parameters, context)
+        feedback.setProgress(40)
+
+        # параллельно считаются районы, ветки внутри района - последовательно
+        threads = self.parameterAsInt(parameters, self.THREADS, context) or os.cpu_count() or 1
+
+        def district_branch(name, xy_in, xy_out):
+            def run(ctx, fb):
+                try:
+                    return self.district_zones([(graph, xy_in, xy_out)], w_crs, pop_index, settings, ctx, fb, 1,
+                                               profiler, name)
+                except QgsProcessingException as e:
+                    fb.reportError(str(e))
+                    return None
+            return run
+
+        feedback.setProgressText(f"расчет зон для {len(districts)} районов...")
+        with profiler.stage("зоны всех районов") as record:
+            district_finals = main1.run_branches([district_branch(*district) for district in districts],
+                                                 context, feedback, threads, 40, 95)
+            record['features'] = sum(1 for finals in district_finals if finals)
+        if feedback.isCanceled():
+            return {}
+
+        written = 0
+        with profiler.stage("запись geopackage") as record:
+            fields = QgsFields()
+            fields.append(QgsField('district', QVariant.String))
+            fields.append(QgsField('cost_band', QVariant.Double))
+            fields.append(QgsField('calc_pop', QVariant.Int))
+            totals = {}
+            for n, (idx, layer_name) in enumerate(self.ZONE_LAYERS):
+                writer = gpkg_writer(output_path, layer_name, fields, QgsWkbTypes.MultiPolygon, w_crs,
+                                     context.transformContext(), n == 0)
+                for (name, _, _), finals in zip(districts, district_finals):
+                    for final in finals or []:
+                        if not final[idx]:
+                            continue
+                        pop_total = 0
+                        for f in final[idx].getFeatures():
+                            geom = f.geometry()
+                            geom.convertToMultiType()
+                            pop_total += f['calc_pop'] or 0
+                            out_f = QgsFeature(fields)
+                            out_f.setGeometry(geom)
+                            out_f.setAttributes([name, final[0], f['calc_pop']])
+                            writer.addFeature(out_f, QgsFeatureSink.FastInsert)
+                            written += 1
+                        totals.setdefault((name, final[0]), {})[idx] = pop_total
+                del writer
+
+            # итоги по населению: район x порог
+            table_fields = QgsFields()
+            table_fields.append(QgsField('district', QVariant.String))
+            table_fields.append(QgsField('cost_band', QVariant.Double))
+            for _, layer_name in self.ZONE_LAYERS:
+                table_fields.append(QgsField('pop_' + layer_name.split('_')[1], QVariant.Int))
+            writer = gpkg_writer(output_path, 'population', table_fields, QgsWkbTypes.NoGeometry, w_crs,
+                                 context.transformContext(), False)
+            for (name, cost), pops in totals.items():
+                out_f = QgsFeature(table_fields)
+                out_f.setAttributes([name, cost] + [pops.get(idx) for idx, _ in self.ZONE_LAYERS])
+                writer.addFeature(out_f, QgsFeatureSink.FastInsert)
+            del writer
+            record['features'] = written
+
+        failed = [name for (name, _, _), finals in zip(districts, district_finals) if not finals]
+        if failed:
+            feedback.reportError(f"зоны не построены для районов: {', '.join(failed)}")
+
+        results = {self.OUTPUT_GPKG: output_path}
+        profile = profiler.report()
+        feedback.pushInfo(f"профиль: всего {profile['total_seconds']:.2f} с, записано объектов: {written}")
+        if profile_path:
+            profiler.save(profile_path)
+            results[self.PROFILE_OUTPUT] = profile_path
+        return results
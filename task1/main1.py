@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.PyQt.QtCore import QCoreApplication, QThread, QVariant
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
                        QgsProcessingAlgorithm,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterNumber,
@@ -14,14 +16,973 @@ from qgis.core import (QgsProcessing,
                        QgsPointXY,
                        QgsSpatialIndex,
                        QgsField,
+                       QgsFields,
+                       QgsMemoryProviderUtils,
                        QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
+                       QgsWkbTypes,
                        QgsProject,
                        QgsProcessingUtils,
                        QgsFeatureRequest,
                        QgsProcessingParameterBoolean,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFileDestination,
                        QgsProcessingException,
-                       QgsCoordinateTransform)
+                       QgsCoordinateTransform,
+                       QgsProviderRegistry,
+                       QgsFeatureSource,
+                       QgsVectorDataProvider,
+                       QgsProcessingFeatureSourceDefinition,
+                       QgsRectangle)
 from qgis import processing
+from osgeo import gdal, ogr
+
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from array import array
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from scipy.ndimage import binary_dilation
+except ImportError:
+    binary_dilation = None
+
+try:
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix, csr_matrix
+    from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+except ImportError:
+    cKDTree = None
+    csgraph_dijkstra = None
+
+
+# точность ключа узла графа (знаков после запятой в единицах crs графа)
+NODE_KEY_DIGITS = 3
+
+
+def node_keys(xs, ys):
+    # ключи узлов: координаты, округленные до NODE_KEY_DIGITS
+    return np.round(xs, NODE_KEY_DIGITS) + 1j * np.round(ys, NODE_KEY_DIGITS)
+
+
+def transform_xy(xs, ys, transform):
+    # пакетная трансформация координат одним вызовом через мультиточку
+    if transform is None or transform.isShortCircuited() or len(xs) == 0:
+        return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    geom = QgsGeometry.fromMultiPointXY([QgsPointXY(x, y) for x, y in zip(xs, ys)])
+    geom.transform(transform)
+    pts = geom.asMultiPoint()
+    return (np.fromiter((p.x() for p in pts), dtype=float, count=len(pts)),
+            np.fromiter((p.y() for p in pts), dtype=float, count=len(pts)))
+
+
+class PointIndex:
+    # поиск ближайшей точки: kd-дерево scipy, при его отсутствии - QgsSpatialIndex
+
+    def __init__(self, xs, ys):
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        if cKDTree is not None:
+            self._tree = cKDTree(np.column_stack([self.xs, self.ys]))
+            self._index = None
+        else:
+            self._tree = None
+            self._index = QgsSpatialIndex()
+            for i, (x, y) in enumerate(zip(self.xs, self.ys)):
+                self._index.addFeature(i, QgsRectangle(x, y, x, y))
+
+    def __len__(self):
+        return len(self.xs)
+
+    def nearest(self, xs, ys, k=1):
+        # индексы k ближайших точек для массива запросов (при k > 1 - матрица, -1 там где точек не хватило)
+        k = min(k, len(self.xs))
+        if self._tree is not None:
+            _, idx = self._tree.query(np.column_stack([xs, ys]), k=k)
+            idx = np.asarray(idx, dtype=np.int64)
+            if k > 1:
+                idx[idx >= len(self.xs)] = -1
+            return idx
+        idx = np.full((len(xs), k), -1, dtype=np.int64)
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            found = self._index.nearestNeighbor(QgsPointXY(x, y), k)[:k]
+            idx[i, :len(found)] = found
+        return idx[:, 0] if k == 1 else idx
+
+    def within(self, x, y, radius):
+        # индексы точек не дальше radius от точки (x, y)
+        if self._tree is not None:
+            return np.asarray(self._tree.query_ball_point((x, y), radius), dtype=np.int64)
+        found = np.asarray(self._index.intersects(QgsRectangle(x - radius, y - radius, x + radius, y + radius)),
+                           dtype=np.int64)
+        return found[np.hypot(self.xs[found] - x, self.ys[found] - y) <= radius]
+
+
+class BranchFeedback(QgsProcessingFeedback):
+    # обратная связь параллельной ветки: сообщения копятся и выводятся из основного потока
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._messages = []
+
+    def _push(self, method, text):
+        # method - имя метода обратной связи основного потока, которым выводится сообщение
+        with self._lock:
+            self._messages.append((method, text))
+
+    def pushInfo(self, info):
+        self._push('pushInfo', info)
+
+    def setProgressText(self, text):
+        self._push('pushInfo', text)
+
+    def reportError(self, error, fatalError=False):
+        self._push('reportError', error)
+
+    def pushWarning(self, warning):
+        self._push('pushWarning', warning)
+
+    def pushDebugInfo(self, info):
+        self._push('pushDebugInfo', info)
+
+    def pushCommandInfo(self, info):
+        self._push('pushCommandInfo', info)
+
+    def pushConsoleInfo(self, info):
+        self._push('pushConsoleInfo', info)
+
+    def flush_to(self, feedback):
+        with self._lock:
+            messages, self._messages = self._messages, []
+        for method, text in messages:
+            getattr(feedback, method)(text)
+
+
+def run_branches(branches, context, feedback, workers, progress_from, progress_to):
+    # независимые ветки fn(ctx, fb) -> результат, в пуле потоков;
+    # у каждой ветки свой контекст, ее временные слои передаются в основной контекст
+    results = []
+    if workers <= 1 or len(branches) <= 1:
+        for i, branch in enumerate(branches):
+            if feedback.isCanceled(): break
+            results.append(branch(context, feedback))
+            feedback.setProgress(progress_from + (progress_to - progress_from) * (i + 1) / len(branches))
+        return results + [None] * (len(branches) - len(results))
+
+    main_thread = QThread.currentThread()
+    feedbacks = [BranchFeedback() for _ in branches]
+    contexts = [None] * len(branches)
+
+    def run(i):
+        # контекст создается в потоке ветки и по завершении передается основному потоку
+        # ветки, не начатые до отмены, не запускаются
+        if feedbacks[i].isCanceled():
+            return None
+        ctx = QgsProcessingContext()
+        ctx.copyThreadSafeSettings(context)
+        contexts[i] = ctx
+        try:
+            return branches[i](ctx, feedbacks[i])
+        finally:
+            ctx.pushToThread(main_thread)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(branches))) as pool:
+        futures = [pool.submit(run, i) for i in range(len(branches))]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.2)
+            if feedback.isCanceled():
+                for fb in feedbacks:
+                    fb.cancel()
+            for fb in feedbacks:
+                fb.flush_to(feedback)
+            done = len(futures) - len(pending)
+            feedback.setProgress(progress_from + (progress_to - progress_from) * done / len(futures))
+
+    for fb in feedbacks:
+        fb.flush_to(feedback)
+    for ctx in contexts:
+        if ctx is not None:
+            context.takeResultsFrom(ctx)
+    return [f.result() for f in futures]
+
+
+def peak_rss():
+    # пиковая память процесса в байтах (ru_maxrss: linux - кб, macos - байты); None без модуля resource
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class StageProfiler:
+    # замер этапов и дочерних алгоритмов: время, число объектов, пиковая память процесса;
+    # этапы параллельных веток пишутся из их потоков, поэтому список под блокировкой
+
+    def __init__(self, feedback=None):
+        self.feedback = feedback
+        self.records = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, feedback=None, kind='stage'):
+        # record['features'] заполняет вызывающий код
+        record = {'name': name, 'kind': kind, 'features': None}
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['start'] = round(start - self._started, 4)
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['peak_rss'] = peak_rss()
+            record['rss_growth'] = record['peak_rss'] - rss_before if rss_before is not None else None
+            with self._lock:
+                self.records.append(record)
+            fb = feedback or self.feedback
+            if fb:
+                fb.pushInfo(self.describe(record))
+
+    def run(self, alg_id, params, context, feedback):
+        # дочерний алгоритм с замером; число объектов - у его выходного слоя
+        with self.stage(alg_id, feedback, kind='child') as record:
+            result = processing.run(alg_id, params, context=context, feedback=feedback, is_child_algorithm=True)
+            output = layer_from_result(result.get('OUTPUT'), context)
+            if output is not None and hasattr(output, 'featureCount'):
+                record['features'] = output.featureCount()
+        return result
+
+    @staticmethod
+    def describe(record):
+        text = f"профиль: {record['name']} - {record['seconds']:.2f} с"
+        if record['features'] is not None:
+            text += f", объектов: {record['features']}"
+        if record['peak_rss'] is not None:
+            text += f", пик памяти: {record['peak_rss'] / 2 ** 20:.0f} мб"
+        return text
+
+    def report(self):
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r['start'])
+        return {'total_seconds': round(time.perf_counter() - self._started, 4),
+                'peak_rss': peak_rss(), 'stages': records}
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+
+def prune_cache(folder, keep):
+    # в папке кэша остаются keep файлов, использованных последними; недописанные файлы не трогаются
+    try:
+        entries = [e for e in os.scandir(folder)
+                   if e.is_file() and e.name.endswith('.npz') and not e.name.endswith('.tmp.npz')]
+        entries.sort(key=lambda e: e.stat().st_mtime_ns, reverse=True)
+    except OSError:
+        return 0
+    removed = 0
+    for entry in entries[keep:]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def layer_snapshot(layer):
+    # потокобезопасный снимок слоя для чтения из параллельной ветки
+    if not layer:
+        return None
+    return (QgsVectorLayerFeatureSource(layer), layer.fields(), layer.wkbType(), layer.crs(), layer.name())
+
+
+def snapshot_layer(snapshot, ctx):
+    # копия снимка во временном слое, принадлежащем потоку ветки
+    source, fields, wkb_type, crs, name = snapshot
+    layer = QgsMemoryProviderUtils.createMemoryLayer(name, fields, wkb_type, crs)
+    layer.dataProvider().addFeatures(list(source.getFeatures()))
+    ctx.temporaryLayerStore().addMapLayer(layer)
+    return layer
+
+
+def parse_costs(text):
+    # список порогов из строки вида "300, 500; 800" - по возрастанию, без повторов
+    try:
+        values = {float(token) for token in re.split(r'[;,\s]+', text or '') if token}
+    except ValueError:
+        raise QgsProcessingException(f"ошибка: неверный список порогов: {text}")
+    if any(v <= 0 for v in values):
+        raise QgsProcessingException("ошибка: пороги доступности должны быть положительными.")
+    return sorted(values)
+
+
+def update_layer_digest(hasher, source, fields=(), rect=None):
+    # хэш содержимого векторного слоя: crs, геометрии и значения указанных полей
+    # (только объекты, пересекающие rect в crs слоя, если он задан)
+    hasher.update(source.sourceCrs().authid().encode())
+    req = QgsFeatureRequest()
+    if fields:
+        req.setSubsetOfAttributes(list(fields), source.fields())
+    else:
+        req.setNoAttributes()
+    if rect is not None:
+        req.setFilterRect(rect)
+    for f in source.getFeatures(req):
+        geom = f.geometry()
+        hasher.update(bytes(geom.asWkb()) if geom else b'')
+        for name in fields:
+            hasher.update(repr(f[name]).encode())
+
+
+def update_raster_digest(hasher, raster_layer):
+    # растр не перечитывается: учитываются источник, размер и время изменения файла
+    source = raster_layer.source()
+    hasher.update(source.encode())
+    hasher.update(raster_layer.crs().authid().encode())
+    hasher.update(raster_layer.extent().toString().encode())
+    if os.path.exists(source):
+        st = os.stat(source)
+        hasher.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+
+
+def source_rect(source, rect, rect_crs, transform_context):
+    # прямоугольник rect (в crs rect_crs) в crs источника
+    if not source.sourceCrs().isValid() or source.sourceCrs() == rect_crs:
+        return rect
+    return QgsCoordinateTransform(rect_crs, source.sourceCrs(), transform_context).transformBoundingBox(rect)
+
+
+def grid_rect(rect, step):
+    # прямоугольник, расширенный наружу до линий сетки с шагом step
+    return QgsRectangle(math.floor(rect.xMinimum() / step) * step, math.floor(rect.yMinimum() / step) * step,
+                        math.ceil(rect.xMaximum() / step) * step, math.ceil(rect.yMaximum() / step) * step)
+
+
+def clipped_layer(source, rect, rect_crs, context):
+    # объекты источника, пересекающие прямоугольник, во временном слое контекста
+    req = QgsFeatureRequest().setFilterRect(source_rect(source, rect, rect_crs, context.transformContext()))
+    layer = source.materialize(req)
+    context.temporaryLayerStore().addMapLayer(layer)
+    return layer
+
+
+def stop_tiles(xy_in, xy_out, tile_size, halo):
+    # остановки входа и выезда группируются по квадратным тайлам tile_size (0 - один общий тайл);
+    # для каждого тайла: охват его остановок с ореолом halo и сами остановки входа и выезда
+    xs = np.concatenate([xy_in[0], xy_out[0]])
+    ys = np.concatenate([xy_in[1], xy_out[1]])
+    is_in = np.arange(len(xs)) < len(xy_in[0])
+    if tile_size > 0:
+        keys = np.column_stack([np.floor(xs / tile_size), np.floor(ys / tile_size)])
+        _, tile = np.unique(keys, axis=0, return_inverse=True)
+        tile = tile.reshape(-1)
+    else:
+        tile = np.zeros(len(xs), dtype=np.int64)
+    tiles = []
+    for t in np.unique(tile):
+        m = tile == t
+        rect = QgsRectangle(xs[m].min() - halo, ys[m].min() - halo, xs[m].max() + halo, ys[m].max() + halo)
+        tiles.append((rect, (xs[m & is_in], ys[m & is_in]), (xs[m & ~is_in], ys[m & ~is_in])))
+    return tiles
+
+
+def file_stamp(path):
+    # штамп файла данных: размер и время изменения (у geopackage - и журнала wal)
+    stamp = []
+    for p in (path, path + '-wal'):
+        if os.path.exists(p):
+            st = os.stat(p)
+            stamp += [st.st_size, st.st_mtime_ns]
+    return stamp
+
+
+def crs_key(crs):
+    return crs.authid() or crs.toWkt()
+
+
+def ensure_spatial_index(layer):
+    # у файлов без встроенного индекса (shapefile) создается .qix для выборок по охвату
+    provider = layer.dataProvider()
+    if (provider.hasSpatialIndex() == QgsFeatureSource.SpatialIndexNotPresent
+            and provider.capabilities() & QgsVectorDataProvider.CreateSpatialIndex):
+        provider.createSpatialIndex()
+
+
+class IndexSidecar:
+    # постоянный индекс большого статичного слоя - массивы npz рядом с файлом слоя
+    # (во временной папке, если папка слоя только для чтения);
+    # действителен, пока не изменились штамп файла и ключ (поля, crs, параметры)
+
+    VERSION = 1
+    CACHE_DIR = '.index_cache'
+
+    def __init__(self, path, stamp, key):
+        self.path = path
+        self.meta = {'stamp': stamp, 'key': key}
+
+    @classmethod
+    def for_layer(cls, layer, kind, key):
+        # None, если слой не в файле
+        if layer is None:
+            return None
+        parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        data_path = parts.get('path')
+        if not data_path or not os.path.isfile(data_path):
+            return None
+        ensure_spatial_index(layer)
+        name = f"{os.path.basename(data_path)}.{parts.get('layerName') or layer.name()}.{kind}.idx.npz"
+        folder = os.path.dirname(data_path)
+        if os.access(folder, os.W_OK):
+            path = os.path.join(folder, name)
+        else:
+            digest = hashlib.sha1(data_path.encode()).hexdigest()[:12]
+            path = os.path.join(tempfile.gettempdir(), cls.CACHE_DIR, f"{digest}.{name}")
+        return cls(path, file_stamp(data_path), [cls.VERSION, layer.subsetString()] + list(key))
+
+    def load(self):
+        # массивы индекса или None, если его нет или он устарел
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path) as data:
+                if json.loads(str(data['meta'])) != self.meta:
+                    return None
+                return {name: data[name] for name in data.files if name != 'meta'}
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, arrays):
+        # индекс - дополнительная оптимизация: ошибка записи не прерывает расчет
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp.npz'
+            np.savez(tmp_path, meta=np.array(json.dumps(self.meta)), **arrays)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+def layer_from_result(layer_id_or_obj, context):
+    # слой по результату дочернего алгоритма (id, путь или сам объект)
+    if isinstance(layer_id_or_obj, str):
+        lyr = context.temporaryLayerStore().mapLayer(layer_id_or_obj)
+        if lyr: return lyr
+        lyr = QgsProject.instance().mapLayer(layer_id_or_obj)
+        if lyr: return lyr
+        return QgsProcessingUtils.mapLayerFromString(layer_id_or_obj, context)
+    return layer_id_or_obj
+
+
+def point_xy(features, transform=None):
+    # координаты всех точек (включая части мультиточек) набора объектов
+    xs, ys = [], []
+    for f in features:
+        geom = f.geometry()
+        if not geom or geom.isEmpty():
+            continue
+        pts = geom.asMultiPoint() if geom.isMultipart() else [geom.asPoint()]
+        for p in pts:
+            xs.append(p.x())
+            ys.append(p.y())
+    return transform_xy(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), transform)
+
+
+def lines_layer(pieces, crs, name, chunk=1000):
+    # временный слой линий из массива отрезков (x1, y1, x2, y2), по chunk отрезков на объект
+    layer = QgsVectorLayer(f"MultiLineString?crs={crs.authid()}", name, "memory")
+    pr = layer.dataProvider()
+    pr.addAttributes([QgsField("zone", QVariant.String)])
+    layer.updateFields()
+    feats = []
+    for start in range(0, len(pieces), chunk):
+        part = pieces[start:start + chunk].tolist()
+        f = QgsFeature(layer.fields())
+        f.setGeometry(QgsGeometry.fromMultiPolylineXY(
+            [[QgsPointXY(x1, y1), QgsPointXY(x2, y2)] for x1, y1, x2, y2 in part]))
+        f.setAttributes([name])
+        feats.append(f)
+    pr.addFeatures(feats)
+    layer.updateExtents()
+    return layer
+
+
+def rasterize_zone(pieces, distance, cell, min_hole_area=0, max_cells=100_000_000):
+    # сплошная зона без буфера линий: отрезки растрируются на сетку cell,
+    # маска расширяется диском радиуса distance и обводится gdal.Polygonize
+    if not len(pieces):
+        return QgsGeometry()
+    xs = np.concatenate([pieces[:, 0], pieces[:, 2]])
+    ys = np.concatenate([pieces[:, 1], pieces[:, 3]])
+    x0, y1 = xs.min() - distance - cell, ys.max() + distance + cell
+    width = (xs.max() + distance + cell - x0)
+    height = (y1 - (ys.min() - distance - cell))
+    # слишком мелкая ячейка для такой зоны - укрупняем
+    cell = max(cell, math.sqrt(width * height / max_cells))
+    cols, rows = int(math.ceil(width / cell)), int(math.ceil(height / cell))
+
+    # точки вдоль отрезков с шагом не больше половины ячейки
+    seg_len = np.hypot(pieces[:, 2] - pieces[:, 0], pieces[:, 3] - pieces[:, 1])
+    steps = np.ceil(seg_len / (cell / 2)).astype(np.int64) + 1
+    owner = np.repeat(np.arange(len(pieces)), steps)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(steps) - steps, steps)
+    t = offsets / np.maximum(steps[owner] - 1, 1)
+    px = pieces[owner, 0] + t * (pieces[owner, 2] - pieces[owner, 0])
+    py = pieces[owner, 1] + t * (pieces[owner, 3] - pieces[owner, 1])
+    mask = np.zeros((rows, cols), dtype=bool)
+    mask[((y1 - py) / cell).astype(np.int64), ((px - x0) / cell).astype(np.int64)] = True
+
+    # расширение на радиус буфера
+    r = int(math.ceil(distance / cell))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    disk = dx * dx + dy * dy <= (distance / cell) ** 2
+    if binary_dilation is not None:
+        mask = binary_dilation(mask, structure=disk)
+    else:
+        grown = mask.copy()
+        for oy, ox in zip(dy[disk].tolist(), dx[disk].tolist()):
+            grown[max(oy, 0):rows + min(oy, 0), max(ox, 0):cols + min(ox, 0)] |= \
+                mask[max(-oy, 0):rows + min(-oy, 0), max(-ox, 0):cols + min(-ox, 0)]
+        mask = grown
+
+    # обводка маски
+    raster = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((x0, cell, 0, y1, 0, -cell))
+    band = raster.GetRasterBand(1)
+    band.WriteArray(mask.astype(np.uint8))
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    out = vector.CreateLayer('zone')
+    out.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    gdal.Polygonize(band, band, out, 0)
+    parts = []
+    for f in out:
+        # fromWkb - метод экземпляра: заполняет пустую геометрию
+        part = QgsGeometry()
+        part.fromWkb(bytes(f.GetGeometryRef().ExportToWkb()))
+        parts.append(part)
+    geom = QgsGeometry.collectGeometry(parts)
+    if min_hole_area > 0:
+        geom = geom.removeInteriorRings(min_hole_area)
+    return geom
+
+
+class WalkGraph:
+    # неориентированный пешеходный граф: узлы - вершины линий, ребра - отрезки между ними,
+    # смежность хранится в массивах csr, веса - float
+
+    # минимальный вес ребра (нулевые веса csgraph считает отсутствием ребра)
+    MIN_WEIGHT = 1e-9
+
+    def __init__(self, node_x, node_y, edge_u, edge_v, edge_w):
+        keep = edge_u != edge_v
+        self.node_x = np.asarray(node_x, dtype=float)
+        self.node_y = np.asarray(node_y, dtype=float)
+        self.edge_u = np.asarray(edge_u, dtype=np.int64)[keep]
+        self.edge_v = np.asarray(edge_v, dtype=np.int64)[keep]
+        self.edge_w = np.maximum(np.asarray(edge_w, dtype=float)[keep], self.MIN_WEIGHT)
+
+        # csr: для каждого узла - соседи, веса и номера ребер
+        n, m = len(self.node_x), len(self.edge_u)
+        src = np.concatenate([self.edge_u, self.edge_v])
+        order = np.argsort(src, kind='stable')
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self.indices = np.concatenate([self.edge_v, self.edge_u])[order]
+        self.weights = np.concatenate([self.edge_w, self.edge_w])[order]
+        self.edge_ids = np.concatenate([np.arange(m), np.arange(m)])[order]
+        # индекс привязки и матрица csgraph строятся при первом обращении (ветки идут в потоках)
+        self._snap_index = None
+        self._matrix = None
+        self._lazy_lock = threading.Lock()
+
+    @classmethod
+    def from_segments(cls, segments, weights):
+        # узлы определяются совпадением концов отрезков (с точностью NODE_KEY_DIGITS)
+        segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        xs = np.concatenate([segments[:, 0], segments[:, 2]])
+        ys = np.concatenate([segments[:, 1], segments[:, 3]])
+        _, first, inverse = np.unique(node_keys(xs, ys), return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        m = len(segments)
+        return cls(xs[first], ys[first], inverse[:m], inverse[m:], weights)
+
+    @classmethod
+    def load(cls, path):
+        # граф из файла массивов; None, если файла нет или он поврежден
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return cls(data['node_x'], data['node_y'], data['edge_u'], data['edge_v'], data['edge_w'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path):
+        # запись через временный файл, чтобы прерванный прогон не оставил битый кэш
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, node_x=self.node_x, node_y=self.node_y,
+                 edge_u=self.edge_u, edge_v=self.edge_v, edge_w=self.edge_w)
+        os.replace(tmp_path, path)
+
+    @property
+    def node_count(self):
+        return len(self.node_x)
+
+    @property
+    def edge_count(self):
+        return len(self.edge_u)
+
+    def _snap_points_index(self):
+        # точки вдоль ребер с шагом spacing (медиана длины ребра) и номер ребра каждой точки:
+        # у ребра на расстоянии d есть точка не дальше d + spacing / 2
+        ax, ay = self.node_x[self.edge_u], self.node_y[self.edge_u]
+        dx, dy = self.node_x[self.edge_v] - ax, self.node_y[self.edge_v] - ay
+        length = np.hypot(dx, dy)
+        spacing = float(np.median(length[length > 0])) if np.any(length > 0) else 1.0
+        steps = np.ceil(length / spacing).astype(np.int64) + 1
+        owner = np.repeat(np.arange(self.edge_count), steps)
+        offsets = np.arange(len(owner)) - np.repeat(np.cumsum(steps) - steps, steps)
+        t = offsets / np.maximum(steps[owner] - 1, 1)
+        return PointIndex(ax[owner] + t * dx[owner], ay[owner] + t * dy[owner]), owner, spacing
+
+    def snap_points(self, xs, ys):
+        # привязка точек к ближайшему ребру: точка старта делит ребро,
+        # оба конца получают начальную стоимость по своей части ребра;
+        # для каждой привязанной точки также возвращаются ее ребро и положение на нем (0..1)
+        if not len(xs) or not self.edge_count:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0)
+        with self._lazy_lock:
+            if self._snap_index is None:
+                self._snap_index = self._snap_points_index()
+        index, owner, spacing = self._snap_index
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        first = index.nearest(xs, ys)
+        snap_edges = np.empty(len(xs), dtype=np.int64)
+        snap_t = np.empty(len(xs))
+        for i, (px, py) in enumerate(zip(xs.tolist(), ys.tolist())):
+            # ближайшее ребро не дальше ближайшей точки на ребрах, его точки - в пределах полшага от него
+            radius = math.hypot(index.xs[first[i]] - px, index.ys[first[i]] - py) + spacing / 2
+            edges = np.unique(owner[index.within(px, py, radius)])
+            ax, ay = self.node_x[self.edge_u[edges]], self.node_y[self.edge_u[edges]]
+            dx, dy = self.node_x[self.edge_v[edges]] - ax, self.node_y[self.edge_v[edges]] - ay
+            seg2 = dx * dx + dy * dy
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.where(seg2 > 0, np.clip(((px - ax) * dx + (py - ay) * dy) / seg2, 0.0, 1.0), 0.0)
+            best = int(np.argmin((ax + t * dx - px) ** 2 + (ay + t * dy - py) ** 2))
+            snap_edges[i], snap_t[i] = edges[best], t[best]
+        w = self.edge_w[snap_edges]
+        nodes = np.column_stack([self.edge_u[snap_edges], self.edge_v[snap_edges]]).ravel()
+        costs = np.column_stack([snap_t * w, (1.0 - snap_t) * w]).ravel()
+        return nodes, costs, snap_edges, snap_t
+
+    def shortest_costs(self, src_nodes, src_costs, max_cost):
+        # мультиисточниковая дейкстра: один поиск на весь набор источников,
+        # стоимость до каждого узла (inf - недостижим в пределах max_cost)
+        if csgraph_dijkstra is not None:
+            return self._shortest_costs_csgraph(src_nodes, src_costs, max_cost)
+        return self._shortest_costs_heap(src_nodes, src_costs, max_cost)
+
+    def _csgraph_matrix(self):
+        # матрица графа для csgraph строится один раз: ребро хранится в строке меньшего узла,
+        # из параллельных ребер (в coo они суммируются) остается минимальное;
+        # последняя строка n пустая - для ребер фиктивного источника
+        with self._lazy_lock:
+            if self._matrix is None:
+                n = self.node_count
+                lo, hi = np.minimum(self.edge_u, self.edge_v), np.maximum(self.edge_u, self.edge_v)
+                order = np.lexsort((self.edge_w, hi, lo))
+                lo, hi, w = lo[order], hi[order], self.edge_w[order]
+                first = np.ones(len(lo), dtype=bool)
+                first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+                self._matrix = coo_matrix((w[first], (lo[first], hi[first])), shape=(n + 1, n + 1)).tocsr()
+        return self._matrix
+
+    def _shortest_costs_csgraph(self, src_nodes, src_costs, max_cost):
+        # источники подключаются к фиктивному узлу n ребрами с начальной стоимостью:
+        # к общей матрице дописывается только строка n (по одному ребру на узел - с наименьшей стоимостью)
+        n = self.node_count
+        base = self._csgraph_matrix()
+        order = np.lexsort((src_costs, src_nodes))
+        nodes, costs = src_nodes[order], src_costs[order]
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = nodes[1:] != nodes[:-1]
+        nodes, costs = nodes[first], np.maximum(costs[first], self.MIN_WEIGHT)
+        indptr = base.indptr.copy()
+        indptr[-1] += len(nodes)
+        matrix = csr_matrix((np.concatenate([base.data, costs]), np.concatenate([base.indices, nodes]), indptr),
+                            shape=(n + 1, n + 1))
+        dist = csgraph_dijkstra(matrix, directed=False, indices=n, limit=max_cost)
+        dist = np.asarray(dist, dtype=float)[:n]
+        # стоимость самого старта не должна включать MIN_WEIGHT
+        dist[dist > max_cost] = np.inf
+        return dist
+
+    def _shortest_costs_heap(self, src_nodes, src_costs, max_cost):
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        weights = self.weights.tolist()
+        dist = [math.inf] * self.node_count
+        heap = []
+        for node, cost in zip(src_nodes.tolist(), src_costs.tolist()):
+            if cost <= max_cost and cost < dist[node]:
+                dist[node] = cost
+                heap.append((cost, node))
+        heapq.heapify(heap)
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            for k in range(indptr[node], indptr[node + 1]):
+                nd = d + weights[k]
+                nxt = indices[k]
+                if nd <= max_cost and nd < dist[nxt]:
+                    dist[nxt] = nd
+                    heapq.heappush(heap, (nd, nxt))
+        return np.asarray(dist, dtype=float)
+
+    def reachable_pieces(self, node_cost, max_cost, snap_edges=None, snap_t=None):
+        # достижимые части ребер в виде отрезков (x1, y1, x2, y2):
+        # ребро целиком, если его покрывают с двух сторон, иначе - куски от каждого конца;
+        # вокруг каждой точки старта (snap_edges, snap_t из snap_points) - кусок ее ребра
+        # в пределах max_cost, даже если оба конца ребра дальше
+        with np.errstate(invalid='ignore'):
+            a = max_cost - node_cost[self.edge_u]
+            b = max_cost - node_cost[self.edge_v]
+            w = self.edge_w
+            full = (a >= 0) & (b >= 0) & (a + b >= w) | (a >= w) | (b >= w)
+            from_u = ~full & (a > 0)
+            from_v = ~full & (b > 0)
+        if snap_edges is None:
+            snap_edges, snap_t = np.empty(0, dtype=np.int64), np.empty(0)
+        reach = max_cost / w[snap_edges]
+        edges = np.concatenate([np.flatnonzero(full), np.flatnonzero(from_u), np.flatnonzero(from_v), snap_edges])
+        t0 = np.concatenate([np.zeros(full.sum()), np.zeros(from_u.sum()),
+                             1.0 - b[from_v] / w[from_v], np.maximum(snap_t - reach, 0.0)])
+        t1 = np.concatenate([np.ones(full.sum()), a[from_u] / w[from_u], np.ones(from_v.sum()),
+                             np.minimum(snap_t + reach, 1.0)])
+        ux, uy = self.node_x[self.edge_u[edges]], self.node_y[self.edge_u[edges]]
+        dx = self.node_x[self.edge_v[edges]] - ux
+        dy = self.node_y[self.edge_v[edges]] - uy
+        return np.column_stack([ux + t0 * dx, uy + t0 * dy, ux + t1 * dx, uy + t1 * dy])
+
+
+class PopulationIndex:
+    # здания с населением в массивах (в crs графа): охваты, население и wkb геометрий;
+    # зона отбирает здания по охватам и проверяет их подготовленной геометрией,
+    # геометрии разбираются из wkb только для зданий-кандидатов
+
+    def __init__(self, bounds, population, wkb, offsets):
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.population = np.asarray(population, dtype=float)
+        self.wkb = np.asarray(wkb, dtype=np.uint8)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._geoms = {}
+
+    @classmethod
+    def from_source(cls, source, pop_field, crs, transform_context, feedback=None, rect=None):
+        # rect (в crs crs) - только здания в этом охвате
+        req = QgsFeatureRequest().setSubsetOfAttributes([pop_field], source.fields())
+        req.setDestinationCrs(crs, transform_context)
+        if rect is not None:
+            req.setFilterRect(rect)
+        bounds, population, chunks, offsets = array('d'), array('d'), [], [0]
+        for f in source.getFeatures(req):
+            if feedback and feedback.isCanceled():
+                break
+            val = f[pop_field]
+            geom = f.geometry()
+            # пустые и нулевые значения не учитываются
+            if not val or not geom or geom.isEmpty():
+                continue
+            box = geom.boundingBox()
+            bounds.extend((box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()))
+            population.append(float(val))
+            chunks.append(bytes(geom.asWkb()))
+            offsets.append(offsets[-1] + len(chunks[-1]))
+        return cls(np.frombuffer(bounds, dtype=float), np.frombuffer(population, dtype=float),
+                   np.frombuffer(b''.join(chunks), dtype=np.uint8), offsets)
+
+    def arrays(self):
+        return {'bounds': self.bounds, 'population': self.population, 'wkb': self.wkb, 'offsets': self.offsets}
+
+    def candidates(self, rect):
+        # здания, охват которых пересекает прямоугольник
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] <= rect.xMaximum()) & (b[:, 2] >= rect.xMinimum())
+                              & (b[:, 1] <= rect.yMaximum()) & (b[:, 3] >= rect.yMinimum()))
+
+    def clipped(self, rect):
+        # здания в охвате rect - отдельным индексом
+        idx = self.candidates(rect)
+        starts, ends = self.offsets[idx], self.offsets[idx + 1]
+        wkb = np.concatenate([self.wkb[s:e] for s, e in zip(starts.tolist(), ends.tolist())]) if len(idx) else np.empty(0)
+        return PopulationIndex(self.bounds[idx], self.population[idx], wkb,
+                               np.concatenate([[0], np.cumsum(ends - starts)]))
+
+    def geometry(self, i):
+        geom = self._geoms.get(i)
+        if geom is None:
+            geom = QgsGeometry()
+            geom.fromWkb(self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes())
+            self._geoms[i] = geom
+        return geom
+
+    def count(self, zone_geom):
+        # суммарное население зданий, пересекающих зону
+        if not zone_geom or zone_geom.isEmpty() or not len(self.population):
+            return 0
+        engine = QgsGeometry.createGeometryEngine(zone_geom.constGet())
+        engine.prepareGeometry()
+        total = 0
+        for i in self.candidates(zone_geom.boundingBox()).tolist():
+            if engine.intersects(self.geometry(i).constGet()):
+                total += self.population[i]
+        return total
+
+
+class ElevationSampler:
+    # выборка высот для узлов графа: все уникальные узлы трансформируются пачкой,
+    # высота берется с ближайшей вершины изолинии (kd-дерево) или из ЦМР,
+    # результат запоминается по ключу узла
+
+    # шаг уплотнения изолиний, чтобы ближайшая вершина была близка к ближайшей линии
+    CONTOUR_DENSIFY = 10.0
+    # размер блока чтения растра (пикселей по стороне)
+    RASTER_TILE = 1024
+
+    def __init__(self, graph_crs, sampler_crs, transform_context):
+        self.transform = None
+        if graph_crs.isValid() and sampler_crs.isValid() and graph_crs != sampler_crs:
+            self.transform = QgsCoordinateTransform(graph_crs, sampler_crs, transform_context)
+        self._cache = {}
+        self._index = None
+        self._vertices = (np.empty(0), np.empty(0), np.empty(0))
+        self._raster = None
+
+    @classmethod
+    def from_vertices(cls, xs, ys, zs, sampler_crs, graph_crs, transform_context):
+        # вершины изолиний (в crs изолиний) с высотами; kd-дерево строится при первой выборке
+        sampler = cls(graph_crs, sampler_crs, transform_context)
+        sampler._vertices = (np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(zs, dtype=float))
+        return sampler
+
+    def vertices(self, rect=None):
+        # вершины изолиний для индекса на диске; rect (в crs изолиний) - только вершины в нем
+        xs, ys, zs = self._vertices
+        if rect is not None:
+            m = ((xs >= rect.xMinimum()) & (xs <= rect.xMaximum())
+                 & (ys >= rect.yMinimum()) & (ys <= rect.yMaximum()))
+            xs, ys, zs = xs[m], ys[m], zs[m]
+        return {'xs': xs, 'ys': ys, 'zs': zs}
+
+    @classmethod
+    def from_contours(cls, source, field, graph_crs, transform_context, feedback=None):
+        densify = not source.sourceCrs().isGeographic()
+        xs, ys, zs = [], [], []
+        req = QgsFeatureRequest().setSubsetOfAttributes([field], source.fields())
+        for f in source.getFeatures(req):
+            if feedback and feedback.isCanceled():
+                break
+            geom = f.geometry()
+            if not geom or geom.isEmpty():
+                continue
+            if densify:
+                geom = geom.densifyByDistance(cls.CONTOUR_DENSIFY)
+            val = f[field]
+            z = float(val) if val is not None else 0
+            for v in geom.vertices():
+                xs.append(v.x())
+                ys.append(v.y())
+                zs.append(z)
+        return cls.from_vertices(xs, ys, zs, source.sourceCrs(), graph_crs, transform_context)
+
+    @classmethod
+    def from_dem(cls, raster_layer, graph_crs, transform_context, band=1):
+        sampler = cls(graph_crs, raster_layer.crs(), transform_context)
+        sampler._raster = (raster_layer.dataProvider(), band, raster_layer.extent(),
+                           raster_layer.width(), raster_layer.height())
+        return sampler
+
+    def __len__(self):
+        return len(self._cache)
+
+    def sample(self, xs, ys):
+        # высоты для массива узлов (в crs графа); повторные узлы не пересчитываются
+        keys = node_keys(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+        uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        z_uniq = np.fromiter((self._cache.get(k, np.nan) for k in uniq.tolist()),
+                             dtype=float, count=len(uniq))
+        missing = np.flatnonzero(np.isnan(z_uniq))
+        if len(missing):
+            src = first[missing]
+            tx, ty = transform_xy(np.asarray(xs, dtype=float)[src],
+                                  np.asarray(ys, dtype=float)[src], self.transform)
+            z_new = self._sample_raster(tx, ty) if self._raster else self._sample_contours(tx, ty)
+            z_uniq[missing] = z_new
+            self._cache.update(zip(uniq[missing].tolist(), z_new.tolist()))
+        return z_uniq[inverse.reshape(-1)]
+
+    def _sample_contours(self, xs, ys):
+        vx, vy, vz = self._vertices
+        if not len(vx):
+            return np.zeros(len(xs))
+        if self._index is None:
+            self._index = PointIndex(vx, vy)
+        return vz[self._index.nearest(xs, ys)]
+
+    def _sample_raster(self, xs, ys):
+        provider, band, extent, width, height = self._raster
+        x_res = extent.width() / width
+        y_res = extent.height() / height
+        cols = np.floor((xs - extent.xMinimum()) / x_res).astype(np.int64)
+        rows = np.floor((extent.yMaximum() - ys) / y_res).astype(np.int64)
+        z = np.zeros(len(xs))
+        inside = np.flatnonzero((cols >= 0) & (cols < width) & (rows >= 0) & (rows < height))
+        if not len(inside):
+            return z
+
+        # узлы читаются поблочно: один запрос к провайдеру на блок RASTER_TILE x RASTER_TILE
+        tile = self.RASTER_TILE
+        tile_ids = (rows[inside] // tile) * (width // tile + 1) + cols[inside] // tile
+        order = np.argsort(tile_ids, kind='stable')
+        bounds = np.flatnonzero(np.diff(tile_ids[order])) + 1
+        for group in np.split(inside[order], bounds):
+            r0 = (rows[group[0]] // tile) * tile
+            c0 = (cols[group[0]] // tile) * tile
+            r1 = min(r0 + tile, height)
+            c1 = min(c0 + tile, width)
+            block_extent = QgsRectangle(extent.xMinimum() + c0 * x_res, extent.yMaximum() - r1 * y_res,
+                                        extent.xMinimum() + c1 * x_res, extent.yMaximum() - r0 * y_res)
+            block = provider.block(band, block_extent, int(c1 - c0), int(r1 - r0))
+            if not block.isValid():
+                continue
+            for i in group:
+                r, c = int(rows[i] - r0), int(cols[i] - c0)
+                if not block.isNoData(r, c):
+                    z[i] = block.value(r, c)
+        return z
+
 
 class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
     INPUT_STOPS_IN = 'INPUT_STOPS_IN'
@@ -29,6 +990,7 @@ class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
     INPUT_GRAPH = 'INPUT_GRAPH'
     INPUT_CONTOURS = 'INPUT_CONTOURS'
     CONTOUR_FIELD = 'CONTOUR_FIELD'
+    INPUT_DEM = 'INPUT_DEM'
     INPUT_BUILDINGS = 'INPUT_BUILDINGS'
     POPULATION_FIELD = 'POPULATION_FIELD'
     MAX_COST = 'MAX_COST'
@@ -36,6 +998,38 @@ class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
     OUTPUT_LAYER_OUT = 'OUTPUT_LAYER_OUT'
     OUTPUT_INTERSECTION = 'OUTPUT_INTERSECTION'
     USE_RELIEF = 'USE_RELIEF'
+    USE_CACHE = 'USE_CACHE'
+    COST_BANDS = 'COST_BANDS'
+    BANDS_AS_RINGS = 'BANDS_AS_RINGS'
+    ZONE_ENGINE = 'ZONE_ENGINE'
+    GRID_CELL = 'GRID_CELL'
+    THREADS = 'THREADS'
+    SEGMENTATION = 'SEGMENTATION'
+    PROFILE_OUTPUT = 'PROFILE_OUTPUT'
+    CLIP_TO_STOPS = 'CLIP_TO_STOPS'
+    TILE_SIZE = 'TILE_SIZE'
+
+    # длина нарезки графа при учете рельефа, м
+    SEGMENT_LENGTH = 30
+    # штраф за 1 м перепада высот, условных метров
+    SLOPE_PENALTY = 5.0
+    # размер пачки объектов графа при расчете весов
+    GRAPH_BATCH = 50000
+    # ширина буфера вокруг достижимых улиц, м
+    BUFFER_DISTANCE = 70
+    # пустоты меньше этой площади заливаются, м2
+    MIN_HOLE_AREA = 1000000
+    # папка кэша подготовленных графов (рядом с проектом)
+    GRAPH_CACHE_DIR = '.graph_cache'
+    # версия формата кэша, меняется при изменении способа подготовки графа
+    GRAPH_CACHE_VERSION = 1
+    # сколько последних использованных графов хранится в кэше, старые удаляются
+    GRAPH_CACHE_KEEP = 32
+    # запас изолиний за охватом обрезки (концы ребер, выходящих за охват), м
+    CONTOUR_CLIP_MARGIN = 500
+    # шаг сетки, до которой расширяется охват обрезки графа: близкие охваты
+    # (другой порог, другой набор остановок рядом) дают один и тот же кэш, м
+    CLIP_GRID = 2000
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -64,17 +1058,41 @@ class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterVectorLayer(
             self.INPUT_STOPS_OUT, self.tr('Остановки (Выезд из района)'), [QgsProcessing.TypeVectorPoint]))
 
+        self.add_network_parameters()
+
+        # граф, изолинии и здания берутся только в охвате остановок с запасом на наибольший порог
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.CLIP_TO_STOPS, self.tr('Обрезать данные по охвату остановок (с запасом на лимит)'), defaultValue=False))
+
+        # разбиение остановок на тайлы, каждый со своим обрезанным графом
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TILE_SIZE, self.tr('Размер тайла, м (0 - без разбиения)'), type=QgsProcessingParameterNumber.Double, defaultValue=0.0, minValue=0.0))
+
+        # выходные слои
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_LAYER_IN, self.tr('Зона: Доступность В РАЙОН')))
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_LAYER_OUT, self.tr('Зона: Доступность ИЗ РАЙОНА')))
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_INTERSECTION, self.tr('Зона: ПОЛНАЯ ДОСТУПНОСТЬ')))
+
+        self.add_profile_parameter()
+
+    def add_network_parameters(self):
+        # граф, рельеф, здания и настройки расчета зон - общие для одиночного и пакетного расчета
+
         # пешеходный граф дорог
         self.addParameter(QgsProcessingParameterFeatureSource(
             self.INPUT_GRAPH, self.tr('Пешеходный граф (линии)'), [QgsProcessing.TypeVectorLine]))
 
         # изолинии высот для учета рельефа
         self.addParameter(QgsProcessingParameterFeatureSource(
-            self.INPUT_CONTOURS, self.tr('Изолинии высот'), [QgsProcessing.TypeVectorLine]))
+            self.INPUT_CONTOURS, self.tr('Изолинии высот'), [QgsProcessing.TypeVectorLine], optional=True))
         
         # поле с высотой в изолиниях
         self.addParameter(QgsProcessingParameterField(
-            self.CONTOUR_FIELD, self.tr('Поле высоты (в изолиниях)'), parentLayerParameterName=self.INPUT_CONTOURS, type=QgsProcessingParameterField.Numeric))
+            self.CONTOUR_FIELD, self.tr('Поле высоты (в изолиниях)'), parentLayerParameterName=self.INPUT_CONTOURS, type=QgsProcessingParameterField.Numeric, optional=True))
+
+        # цифровая модель рельефа (geotiff), используется вместо изолиний
+        self.addParameter(QgsProcessingParameterRasterLayer(
+            self.INPUT_DEM, self.tr('ЦМР (растр высот, вместо изолиний)'), optional=True))
 
         # здания с населением
         self.addParameter(QgsProcessingParameterFeatureSource(
@@ -88,42 +1106,118 @@ class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber(
             self.MAX_COST, self.tr('Лимит доступности (условные метры с учетом рельефа)'), type=QgsProcessingParameterNumber.Double, defaultValue=500.0))
 
+        # несколько порогов за один расчет кратчайших путей (заменяет лимит)
+        self.addParameter(QgsProcessingParameterString(
+            self.COST_BANDS, self.tr('Полосы доступности через запятую, напр. 300,500,800,1200 (пусто - только лимит)'), optional=True))
+
+        # полосы в виде колец вместо вложенных полигонов
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.BANDS_AS_RINGS, self.tr('Полосы в виде колец'), defaultValue=False))
+
         # флаг учета рельефа
         self.addParameter(QgsProcessingParameterBoolean(
             self.USE_RELIEF, self.tr('Учитывать рельеф'), defaultValue=True))
 
-        # выходные слои
-        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_LAYER_IN, self.tr('Зона: Доступность В РАЙОН')))
-        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_LAYER_OUT, self.tr('Зона: Доступность ИЗ РАЙОНА')))
-        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT_INTERSECTION, self.tr('Зона: ПОЛНАЯ ДОСТУПНОСТЬ')))
+        # способ сегментации графа при учете рельефа
+        self.addParameter(QgsProcessingParameterEnum(
+            self.SEGMENTATION, self.tr('Сегментация графа (при учете рельефа)'),
+            options=[self.tr(f'Нарезка по {self.SEGMENT_LENGTH} м'), self.tr('По пересечениям с изолиниями')], defaultValue=0))
 
-    def processAlgorithm(self, parameters, context, feedback):
-        
-        # получаем параметры
+        # флаг кэширования подготовленного графа на диске
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.USE_CACHE, self.tr('Кэшировать подготовленный граф'), defaultValue=True))
+
+        # способ построения полигона зоны
+        self.addParameter(QgsProcessingParameterEnum(
+            self.ZONE_ENGINE, self.tr('Построение полигона зоны'),
+            options=[self.tr('Буфер линий (точно)'), self.tr('Растровая маска (быстро)')], defaultValue=0))
+
+        # размер ячейки растровой маски
+        self.addParameter(QgsProcessingParameterNumber(
+            self.GRID_CELL, self.tr('Ячейка растровой маски, м'), type=QgsProcessingParameterNumber.Double, defaultValue=10.0, minValue=0.5))
+
+        # число потоков для независимых веток (0 - по числу ядер, 1 - последовательно)
+        self.addParameter(QgsProcessingParameterNumber(
+            self.THREADS, self.tr('Число потоков (0 - по числу ядер)'), type=QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0))
+
+    def add_profile_parameter(self):
+        # профиль прогона: время, число объектов и память по этапам
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.PROFILE_OUTPUT, self.tr('Профиль этапов (JSON)'), self.tr('JSON (*.json)'), optional=True, createByDefault=False))
+
+    def graph_cache_path(self, parameters, context, clip=None):
+        # путь к кэшу графа: ключ - хэш содержимого графа и рельефа и параметров подготовки;
+        # при обрезке - охват и только попавшие в него объекты
         use_relief = self.parameterAsBoolean(parameters, self.USE_RELIEF, context)
-        max_cost = self.parameterAsDouble(parameters, self.MAX_COST, context)
+        segmentation = self.parameterAsEnum(parameters, self.SEGMENTATION, context)
+        clip_key = tuple(round(v, NODE_KEY_DIGITS) for v in (clip.xMinimum(), clip.yMinimum(), clip.xMaximum(), clip.yMaximum())) if clip else None
+        hasher = hashlib.sha1(repr((self.GRAPH_CACHE_VERSION, use_relief, segmentation, self.SEGMENT_LENGTH, self.SLOPE_PENALTY,
+                                    ElevationSampler.CONTOUR_DENSIFY, NODE_KEY_DIGITS, clip_key)).encode())
+        graph_layer = self.parameterAsVectorLayer(parameters, self.INPUT_GRAPH, context)
+        update_layer_digest(hasher, graph_layer, rect=clip)
+        
+        if use_relief:
+            dem_layer = self.parameterAsRasterLayer(parameters, self.INPUT_DEM, context)
+            source_contours = self.parameterAsSource(parameters, self.INPUT_CONTOURS, context)
+            if dem_layer:
+                update_raster_digest(hasher, dem_layer)
+            elif source_contours:
+                contour_field = self.parameterAsString(parameters, self.CONTOUR_FIELD, context)
+                contour_rect = source_rect(source_contours, clip.buffered(self.CONTOUR_CLIP_MARGIN), graph_layer.sourceCrs(),
+                                           context.transformContext()) if clip else None
+                update_layer_digest(hasher, source_contours, [contour_field] if contour_field else [], contour_rect)
         
-        # вспомогательная функция для получения слоя
-        def get_layer_obj(layer_id_or_obj):
-            if isinstance(layer_id_or_obj, str):
-                lyr = context.temporaryLayerStore().mapLayer(layer_id_or_obj)
-                if lyr: return lyr
-                lyr = QgsProject.instance().mapLayer(layer_id_or_obj)
-                if lyr: return lyr
-                return QgsProcessingUtils.mapLayerFromString(layer_id_or_obj, context)
-            return layer_id_or_obj
+        project = context.project()
+        folder = project.absolutePath() if project else ''
+        return os.path.join(folder or tempfile.gettempdir(), self.GRAPH_CACHE_DIR, hasher.hexdigest() + '.npz')
 
+    def prepare_graph(self, parameters, context, feedback, profiler=None, clip=None):
+        # этапы 1-2: сегментация графа и расчет весов ребер с учетом рельефа;
+        # clip - охват в crs графа: граф и изолинии берутся только в нем
+        profiler = profiler or StageProfiler(feedback)
+        use_relief = self.parameterAsBoolean(parameters, self.USE_RELIEF, context)
+        
         # подготовка графа
         raw_graph_source = self.parameterAsVectorLayer(parameters, self.INPUT_GRAPH, context)
+        contours_input = parameters.get(self.INPUT_CONTOURS)
+        source_contours = self.parameterAsSource(parameters, self.INPUT_CONTOURS, context)
+        contours_layer = self.static_layer(parameters, self.INPUT_CONTOURS, context)
+        contours_rect = None
+        if clip is not None:
+            graph_crs = raw_graph_source.sourceCrs()
+            with profiler.stage("обрезка графа и изолиний по охвату") as record:
+                raw_graph_source = clipped_layer(raw_graph_source, clip, graph_crs, context)
+                record['features'] = raw_graph_source.featureCount()
+                if use_relief and source_contours:
+                    contours_rect = source_rect(source_contours, clip.buffered(self.CONTOUR_CLIP_MARGIN), graph_crs,
+                                                context.transformContext())
+                    source_contours = contours_input = clipped_layer(source_contours, clip.buffered(self.CONTOUR_CLIP_MARGIN),
+                                                                     graph_crs, context)
         
-        if use_relief:
-            feedback.setProgressText("этап 1: сегментация графа (нарезка по 30м)...")
-            split_graph_dict = processing.run("native:splitlinesbylength", {
+        split_by_contours = self.parameterAsEnum(parameters, self.SEGMENTATION, context) == 1
+        if use_relief and split_by_contours and self.parameterAsRasterLayer(parameters, self.INPUT_DEM, context):
+            feedback.pushInfo("при рельефе из цмр изолиний нет - граф нарезается по длине.")
+            split_by_contours = False
+        
+        if use_relief and split_by_contours:
+            # ребра делятся только в точках пересечения с изолиниями: концы каждого куска
+            # лежат на изолиниях, штраф тот же, а ровные участки не дробятся;
+            # нарезанный граф пишется в geopackage и читается потоком, а не держится в памяти
+            feedback.setProgressText("этап 1: сегментация графа (по пересечениям с изолиниями)...")
+            split_graph_dict = profiler.run("native:splitwithlines", {
                 'INPUT': raw_graph_source,
-                'LENGTH': 30, 
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback, is_child_algorithm=True)
-            working_graph_layer = get_layer_obj(split_graph_dict['OUTPUT']) 
+                'LINES': contours_input,
+                'OUTPUT': QgsProcessingUtils.generateTempFilename('graph_split.gpkg')
+            }, context, feedback)
+            working_graph_layer = layer_from_result(split_graph_dict['OUTPUT'], context)
+        elif use_relief:
+            feedback.setProgressText(f"этап 1: сегментация графа (нарезка по {self.SEGMENT_LENGTH}м)...")
+            split_graph_dict = profiler.run("native:splitlinesbylength", {
+                'INPUT': raw_graph_source,
+                'LENGTH': self.SEGMENT_LENGTH,
+                'OUTPUT': QgsProcessingUtils.generateTempFilename('graph_split.gpkg')
+            }, context, feedback)
+            working_graph_layer = layer_from_result(split_graph_dict['OUTPUT'], context) 
         else:
             feedback.setProgressText("этап 1: подготовка графа (без нарезки)...")
             working_graph_layer = raw_graph_source
@@ -131,242 +1225,504 @@ class TransportAccessibilityIsochrones(QgsProcessingAlgorithm):
         if not working_graph_layer:
             raise QgsProcessingException("ошибка: не удалось создать рабочий граф.")
 
-        # настройка функции получения высоты
-        get_z = lambda p: 0
+        # настройка выборки высот
+        sampler = None
         
         if use_relief:
             feedback.setProgressText("подготовка данных рельефа...")
-            source_contours = self.parameterAsSource(parameters, self.INPUT_CONTOURS, context)
-            contour_field = self.parameterAsString(parameters, self.CONTOUR_FIELD, context)
-            
-            # строим пространственный индекс изолиний
-            contour_index = QgsSpatialIndex(source_contours.getFeatures(), feedback)
-            # кэшируем значения высот
-            contour_data = {f.id(): f[contour_field] for f in source_contours.getFeatures()}
-            
-            # трансформация координат между системами
             crs_graph = working_graph_layer.sourceCrs()
-            crs_contours = source_contours.sourceCrs()
-            
-            if not crs_graph.isValid() or not crs_contours.isValid():
-                feedback.reportError("внимание: неверная система координат у графа или изолиний!")
-
-            transform_to_contours = QgsCoordinateTransform(crs_graph, crs_contours, context.project())
+            dem_layer = self.parameterAsRasterLayer(parameters, self.INPUT_DEM, context)
             
-            def get_z_impl(point):
-                try:
-                    # трансформируем точку в crs изолиний
-                    pt_tr = transform_to_contours.transform(point)
-                    # ищем ближайшую изолинию
-                    nearest_ids = contour_index.nearestNeighbor(pt_tr, 1)
-                    if not nearest_ids: return 0
-                    # берем значение высоты
-                    val = contour_data.get(nearest_ids[0], 0)
-                    return float(val) if val is not None else 0
-                except Exception as e:
-                    return 0
+            if dem_layer:
+                crs_relief = dem_layer.crs()
+                sampler = ElevationSampler.from_dem(dem_layer, crs_graph, context.transformContext())
+            else:
+                contour_field = self.parameterAsString(parameters, self.CONTOUR_FIELD, context)
+                if not source_contours or not contour_field:
+                    raise QgsProcessingException("ошибка: для учета рельефа нужны изолинии с полем высоты или цмр.")
+                crs_relief = source_contours.sourceCrs()
+                # индекс вершин изолиний строится один раз на весь прогон и хранится рядом со слоем;
+                # при обрезке по охвату каждый тайл берет свою часть индекса, прочитанного один раз,
+                # а новый не сохраняется
+                with profiler.stage("индекс изолиний") as record:
+                    sidecar = IndexSidecar.for_layer(contours_layer, 'contours', [
+                        contour_field, not crs_relief.isGeographic(), ElevationSampler.CONTOUR_DENSIFY])
+                    stored = self.load_sidecar(sidecar)
+                    if stored is not None:
+                        sampler = ElevationSampler.from_vertices(stored['xs'], stored['ys'], stored['zs'], crs_relief,
+                                                                 crs_graph, context.transformContext())
+                        if contours_rect is not None:
+                            part = sampler.vertices(contours_rect)
+                            sampler = ElevationSampler.from_vertices(part['xs'], part['ys'], part['zs'], crs_relief,
+                                                                     crs_graph, context.transformContext())
+                        feedback.pushInfo(f"индекс изолиний загружен: {sidecar.path}")
+                    else:
+                        sampler = ElevationSampler.from_contours(source_contours, contour_field, crs_graph,
+                                                                 context.transformContext(), feedback)
+                        if sidecar and contours_rect is None and not feedback.isCanceled():
+                            sidecar.save(sampler.vertices())
+                    record['features'] = source_contours.featureCount()
             
-            get_z = get_z_impl
+            if not crs_graph.isValid() or not crs_relief.isValid():
+                feedback.reportError("внимание: неверная система координат у графа или данных рельефа!")
 
         # расчет весов ребер графа
-        w_crs = working_graph_layer.sourceCrs()
-        weighted_graph_layer = QgsVectorLayer(f"LineString?crs={w_crs.authid()}&index=yes", "WeightedGraph", "memory")
-        pr = weighted_graph_layer.dataProvider()
-        pr.addAttributes([QgsField("weight", QVariant.Double)])
-        weighted_graph_layer.updateFields()
-
-        features_to_add = []
-        iterator = working_graph_layer.getFeatures()
-        total_feats = working_graph_layer.featureCount()
+        # каждый отрезок между соседними вершинами линии становится ребром графа;
+        # объекты читаются пачками по GRAPH_BATCH, в памяти копятся только массивы отрезков и весов
+        iterator = working_graph_layer.getFeatures(QgsFeatureRequest().setNoAttributes())
+        total_feats = max(working_graph_layer.featureCount(), 1)
         
+        seg_chunks = []
+        weight_chunks = []
         total_penalty_accumulated = 0 
-        debug_printed = False
 
-        feedback.setProgressText("этап 2: расчет стоимости прохода (вес ребра)...")
-        for i, feat in enumerate(iterator):
-            if feedback.isCanceled(): break
-            geom = feat.geometry()
-            if not geom: continue
-            
-            length = geom.length()
-            final_cost = length 
+        def weigh_batch(seg_xy, seg_feat, lengths, end_xy):
+            # веса отрезков одной пачки: длина линии плюс штраф за перепад высот на ее концах
+            costs = np.asarray(lengths, dtype=float)
+            penalty = 0.0
+            if use_relief and lengths:
+                ends = np.asarray(end_xy, dtype=float)
+                valid = ~np.isnan(ends[:, 0])
+                z1 = sampler.sample(ends[valid, 0], ends[valid, 1])
+                z2 = sampler.sample(ends[valid, 2], ends[valid, 3])
+                
+                # штраф за перепад высот: 5 условных метров за 1 метр перепада
+                slope_penalty = np.abs(z1 - z2) * self.SLOPE_PENALTY
+                costs[valid] += slope_penalty
+                penalty = float(slope_penalty.sum())
             
-            if use_relief:
-                if geom.isMultipart():
-                    lines = geom.asMultiPolyline()
-                    line = lines[0] if lines else []
-                else:
-                    line = geom.asPolyline()
-                    
-                if len(line) >= 2:
-                    p1 = QgsPointXY(line[0])
-                    p2 = QgsPointXY(line[-1])
-                    
-                    z1 = get_z(p1)
-                    z2 = get_z(p2)
-                    
-                    delta_h = abs(z1 - z2)
+            # вес линии делится между ее отрезками пропорционально длине
+            segments = np.array(seg_xy, dtype=float).reshape(-1, 4)
+            seg_owner = np.frombuffer(seg_feat, dtype=np.int64)
+            seg_len = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+            owner_len = np.asarray(lengths, dtype=float)[seg_owner]
+            share = np.divide(seg_len, owner_len, out=np.zeros_like(seg_len), where=owner_len > 0)
+            return segments, costs[seg_owner] * share, penalty
+
+        feedback.setProgressText("этап 2: расчет стоимости прохода (вес ребра)...")
+        with profiler.stage("этап 2: веса ребер") as record:
+            seg_xy, seg_feat, lengths, end_xy = array('d'), array('q'), [], []
+            for i, feat in enumerate(iterator):
+                geom = feat.geometry()
+                if geom and not geom.isEmpty():
+                    parts = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+                    if any(len(part) >= 2 for part in parts):
+                        feat_idx = len(lengths)
+                        for part in parts:
+                            for p1, p2 in zip(part[:-1], part[1:]):
+                                seg_xy.extend((p1.x(), p1.y(), p2.x(), p2.y()))
+                                seg_feat.append(feat_idx)
+                        lengths.append(geom.length())
                     
-                    if not debug_printed and i > 10 and delta_h > 0:
-                        feedback.pushInfo(f"debug: проверка рельефа работает! p1_z={z1}, p2_z={z2}, delta={delta_h}")
-                        debug_printed = True
-
-                    # штраф за перепад высот: 5 условных метров за 1 метр перепада
-                    slope_penalty = delta_h * 5.0 
-                    final_cost += slope_penalty
-                    total_penalty_accumulated += slope_penalty
-
-            new_f = QgsFeature()
-            new_f.setGeometry(geom)
-            new_f.setAttributes([final_cost])
-            features_to_add.append(new_f)
+                        if use_relief:
+                            # концы линии собираются для пакетной выборки высот
+                            line = parts[0]
+                            if len(line) >= 2:
+                                end_xy.append((line[0].x(), line[0].y(), line[-1].x(), line[-1].y()))
+                            else:
+                                end_xy.append((np.nan, np.nan, np.nan, np.nan))
             
-            if i % 1000 == 0: 
-                feedback.setProgress(int(10 + (30 * i / total_feats)))
+                if len(lengths) >= self.GRAPH_BATCH:
+                    # пачка готова: веса считаются, объекты пачки освобождаются
+                    if feedback.isCanceled(): break
+                    segments, weights, penalty = weigh_batch(seg_xy, seg_feat, lengths, end_xy)
+                    seg_chunks.append(segments)
+                    weight_chunks.append(weights)
+                    total_penalty_accumulated += penalty
+                    seg_xy, seg_feat, lengths, end_xy = array('d'), array('q'), [], []
+                    feedback.setProgress(int(10 + (20 * i / total_feats)))
 
+            if lengths and not feedback.isCanceled():
+                segments, weights, penalty = weigh_batch(seg_xy, seg_feat, lengths, end_xy)
+                seg_chunks.append(segments)
+                weight_chunks.append(weights)
+                total_penalty_accumulated += penalty
+            record['features'] = sum(len(chunk) for chunk in seg_chunks)
+        
         if use_relief:
+            feedback.pushInfo(f"высоты получены для {len(sampler)} уникальных узлов графа.")
             if total_penalty_accumulated == 0:
                 feedback.reportError("!!! ошибка рельефа: общий начисленный штраф равен 0. проверьте: 1) пересекаются ли слои? 2) верна ли проекция?")
             else:
                 feedback.pushInfo(f"успех: учтен рельеф. общий штраф: {int(total_penalty_accumulated)} м.")
 
-        pr.addFeatures(features_to_add)
-        weighted_graph_layer.updateExtents()
-        
-        # построение сплошных зон доступности
-        feedback.setProgressText("этап 3: построение геометрии изохрон...")
+        with profiler.stage("построение графа") as record:
+            graph = WalkGraph.from_segments(np.concatenate(seg_chunks) if seg_chunks else np.empty((0, 4)),
+                                            np.concatenate(weight_chunks) if weight_chunks else np.empty(0))
+            record['features'] = graph.edge_count
+        feedback.pushInfo(f"граф: {graph.node_count} узлов, {graph.edge_count} ребер.")
+        return graph
+
+    def load_graph(self, parameters, context, feedback, profiler, clip=None):
+        # подготовленный граф берется из кэша, если входные данные не менялись;
+        # охват обрезки расширяется до сетки CLIP_GRID - лишний граф за охватом не меняет зоны
+        if clip is not None:
+            clip = grid_rect(clip, self.CLIP_GRID)
+        graph = None
+        cache_path = None
+        if self.parameterAsBoolean(parameters, self.USE_CACHE, context):
+            feedback.setProgressText("проверка кэша подготовленного графа...")
+            with profiler.stage("кэш графа: проверка и загрузка") as record:
+                cache_path = self.graph_cache_path(parameters, context, clip)
+                graph = WalkGraph.load(cache_path)
+                record['features'] = graph.edge_count if graph else None
+            if graph:
+                feedback.pushInfo(f"граф загружен из кэша: {cache_path}")
+                # время изменения файла - время последнего использования, по нему чистится кэш
+                try:
+                    os.utime(cache_path)
+                except OSError:
+                    pass
         
-        layer_stops_in = self.parameterAsVectorLayer(parameters, self.INPUT_STOPS_IN, context)
-        layer_stops_out = self.parameterAsVectorLayer(parameters, self.INPUT_STOPS_OUT, context)
+        if graph is None:
+            graph = self.prepare_graph(parameters, context, feedback, profiler, clip)
+            if cache_path and not feedback.isCanceled():
+                # кэш - дополнительная оптимизация: ошибка записи не прерывает расчет
+                try:
+                    with profiler.stage("кэш графа: сохранение"):
+                        graph.save(cache_path)
+                    feedback.pushInfo(f"граф сохранен в кэш: {cache_path}")
+                except OSError as e:
+                    feedback.reportError(f"не удалось сохранить кэш графа: {e}")
+                removed = prune_cache(os.path.dirname(cache_path), self.GRAPH_CACHE_KEEP)
+                if removed:
+                    feedback.pushInfo(f"из кэша графа удалено устаревших файлов: {removed}")
+        return graph
 
-        if not layer_stops_in or not layer_stops_out:
-            raise QgsProcessingException("ошибка загрузки слоев остановок.")
+    def load_sidecar(self, sidecar):
+        # массивы индекса на диске читаются один раз за прогон и общие для всех тайлов
+        if sidecar is None:
+            return None
+        loaded = getattr(self, 'sidecar_arrays', None)
+        if loaded is None:
+            return sidecar.load()
+        key = (sidecar.path, json.dumps(sidecar.meta))
+        if key not in loaded:
+            loaded[key] = sidecar.load()
+        return loaded[key]
 
-        def build_zone_polygon(stops_layer, suffix):
-            # построение линий доступности
-            lines_dict = processing.run("native:serviceareafromlayer", {
-                'INPUT': weighted_graph_layer, 
-                'STRATEGY': 0, 
-                'VALUE_BOTH': 'weight',
-                'DEFAULT_DIRECTION': 2,
-                'DEFAULT_VALUE': 0,
-                'START_POINTS': stops_layer,
-                'TRAVEL_COST': max_cost,
-                'INCLUDE_BOUNDS': False,
-                'OUTPUT_LINES': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback, is_child_algorithm=True)
-            
-            res_lines = get_layer_obj(lines_dict['OUTPUT_LINES'])
-            if not res_lines or res_lines.featureCount() == 0:
-                feedback.reportError(f"не удалось построить маршруты для {suffix}")
+    def static_layer(self, parameters, name, context):
+        # слой входа для индекса на диске: только весь слой, без выборки, лимита и фильтра;
+        # несохраненные правки не меняют штамп файла, поэтому редактируемый слой читается заново
+        value = parameters.get(name)
+        if isinstance(value, QgsProcessingFeatureSourceDefinition) and (
+                value.selectedFeaturesOnly or value.featureLimit != -1 or getattr(value, 'filterExpression', '')):
+            return None
+        layer = self.parameterAsVectorLayer(parameters, name, context)
+        if layer is not None and layer.isEditable() and layer.isModified():
+            return None
+        return layer
+
+    def load_population(self, parameters, context, feedback, profiler, crs, rect=None):
+        # индекс зданий строится один раз на весь прогон (в crs графа)
+        pop_source = self.parameterAsSource(parameters, self.INPUT_BUILDINGS, context)
+        pop_field = self.parameterAsString(parameters, self.POPULATION_FIELD, context)
+        # индекс хранится рядом со слоем зданий; при охвате rect берется часть готового индекса
+        with profiler.stage("индекс зданий") as record:
+            sidecar = IndexSidecar.for_layer(self.static_layer(parameters, self.INPUT_BUILDINGS, context),
+                                             'buildings', [pop_field, crs_key(crs)])
+            stored = self.load_sidecar(sidecar)
+            if stored is not None:
+                pop_index = PopulationIndex(**stored)
+                if rect is not None:
+                    pop_index = pop_index.clipped(rect)
+                feedback.pushInfo(f"индекс зданий загружен: {sidecar.path}")
+            else:
+                pop_index = PopulationIndex.from_source(pop_source, pop_field, crs, context.transformContext(),
+                                                        feedback, rect)
+                if sidecar and rect is None and not feedback.isCanceled():
+                    sidecar.save(pop_index.arrays())
+            record['features'] = pop_source.featureCount()
+        return pop_index
+
+    def zone_settings(self, parameters, context):
+        # настройки построения зон (читаются в основном потоке)
+        max_cost = self.parameterAsDouble(parameters, self.MAX_COST, context)
+        return {
+            # пороги доступности: список полос или один лимит
+            'thresholds': parse_costs(self.parameterAsString(parameters, self.COST_BANDS, context)) or [max_cost],
+            'as_rings': self.parameterAsBoolean(parameters, self.BANDS_AS_RINGS, context),
+            'raster_zones': self.parameterAsEnum(parameters, self.ZONE_ENGINE, context) == 1,
+            'grid_cell': self.parameterAsDouble(parameters, self.GRID_CELL, context),
+        }
+
+    def district_zones(self, sources, w_crs, pop_index, settings, context, feedback, threads, profiler, district=''):
+        # зоны одного района; sources - тайлы (граф, остановки входа, остановки выезда),
+        # координаты в crs графа, достижимые участки тайлов объединяются;
+        # результат - список (порог, вход, выход, пересечение) - слои с полем calc_pop
+        thresholds = settings['thresholds']
+        raster_zones = settings['raster_zones']
+        grid_cell = settings['grid_cell']
+        prefix = f"{district}: " if district else ""
+
+        def zone_pieces(side):
+            # достижимые участки для каждого порога: в каждом тайле один поиск от всего набора
+            # остановок до наибольшего порога; число узлов в пределах порога - для профиля
+            pieces = [[] for _ in thresholds]
+            reached = 0
+            for tile in sources:
+                if feedback.isCanceled():
+                    break
+                graph, xy = tile[0], tile[side]
+                if not len(xy[0]):
+                    continue
+                src_nodes, src_costs, snap_edges, snap_t = graph.snap_points(*xy)
+                node_cost = graph.shortest_costs(src_nodes, src_costs, thresholds[-1])
+                reached += int(np.count_nonzero(np.isfinite(node_cost)))
+                for k, cost in enumerate(thresholds):
+                    pieces[k].append(graph.reachable_pieces(node_cost, cost, snap_edges, snap_t))
+            return [np.concatenate(p) if p else np.empty((0, 4)) for p in pieces], reached
+
+        def build_zone_polygon(pieces, suffix, ctx, fb):
+            if not len(pieces):
+                fb.reportError(f"не удалось построить маршруты для {suffix}")
                 return None
+            
+            if raster_zones:
+                # растровая маска вместо цепочки буфер/заливка/исправление
+                fields = QgsFields()
+                fields.append(QgsField("zone", QVariant.String))
+                zone_layer = QgsMemoryProviderUtils.createMemoryLayer(suffix, fields, QgsWkbTypes.MultiPolygon, w_crs)
+                zone_f = QgsFeature(fields)
+                with profiler.stage(f"растровая маска {suffix}", fb) as record:
+                    zone_f.setGeometry(rasterize_zone(pieces, self.BUFFER_DISTANCE, grid_cell, self.MIN_HOLE_AREA))
+                    record['features'] = len(pieces)
+                zone_f.setAttributes([suffix])
+                zone_layer.dataProvider().addFeatures([zone_f])
+                ctx.temporaryLayerStore().addMapLayer(zone_layer)
+                return zone_layer
+            
+            # построение линий доступности
+            res_lines = lines_layer(pieces, w_crs, suffix)
+            ctx.temporaryLayerStore().addMapLayer(res_lines)
 
             # буферизация линий
-            buffer_dict = processing.run("native:buffer", {
-                'INPUT': lines_dict['OUTPUT_LINES'],
-                'DISTANCE': 70, 
+            buffer_dict = profiler.run("native:buffer", {
+                'INPUT': res_lines,
+                'DISTANCE': self.BUFFER_DISTANCE, 
                 'DISSOLVE': True, 
                 'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback, is_child_algorithm=True)
+            }, ctx, fb)
             
             # удаление дырок внутри полигонов
-            feedback.setProgressText(f"заливка пустот для зоны {suffix}...")
-            filled_dict = processing.run("native:deleteholes", {
+            fb.setProgressText(f"заливка пустот для зоны {suffix}...")
+            filled_dict = profiler.run("native:deleteholes", {
                 'INPUT': buffer_dict['OUTPUT'],
-                'MIN_AREA': 1000000,
+                'MIN_AREA': self.MIN_HOLE_AREA,
                 'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback, is_child_algorithm=True)
+            }, ctx, fb)
 
             # исправление геометрии
-            fixed_dict = processing.run("native:fixgeometries", {
+            fixed_dict = profiler.run("native:fixgeometries", {
                 'INPUT': filled_dict['OUTPUT'],
                 'OUTPUT': 'TEMPORARY_OUTPUT'
-            }, context=context, feedback=feedback, is_child_algorithm=True)
+            }, ctx, fb)
             
-            return get_layer_obj(fixed_dict['OUTPUT'])
+            return layer_from_result(fixed_dict['OUTPUT'], ctx)
+
+        def zone_branch(side, name):
+            # ветка одной зоны: поиск от остановок и полигоны всех полос
+            def run(ctx, fb):
+                with profiler.stage(f"кратчайшие пути: {name}", fb) as record:
+                    band_pieces, record['features'] = zone_pieces(side)
+                return [build_zone_polygon(pieces, f"{name} {cost:g}", ctx, fb)
+                        for pieces, cost in zip(band_pieces, thresholds)]
+            return run
+
+        def overlay_branch(alg_id, input_lyr, overlay_lyr):
+            # ветка наложения двух полигональных слоев (пересечение или разность)
+            input_snap, overlay_snap = layer_snapshot(input_lyr), layer_snapshot(overlay_lyr)
+            def run(ctx, fb):
+                res_dict = profiler.run(alg_id, {
+                    'INPUT': snapshot_layer(input_snap, ctx),
+                    'OVERLAY': snapshot_layer(overlay_snap, ctx),
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                }, ctx, fb)
+                return layer_from_result(res_dict['OUTPUT'], ctx)
+            return run
+
+        # построение сплошных зон доступности
+        feedback.setProgressText(f"{prefix}этап 3: построение геометрии изохрон...")
+        with profiler.stage(f"{prefix}этап 3: зоны доступности", feedback) as record:
+            zones_in, zones_out = run_branches([zone_branch(1, f"{prefix}вход"), zone_branch(2, f"{prefix}выход")],
+                                               context, feedback, threads, 40, 60)
+            record['features'] = len(thresholds) * 2
+        # при отмене ветки возвращают None - зоны не строятся дальше
+        if feedback.isCanceled():
+            return []
+        if not all(zones_in) or not all(zones_out):
+             raise QgsProcessingException(f"{prefix}сбой при построении зон.")
 
-        zone_in = build_zone_polygon(layer_stops_in, "вход")
-        zone_out = build_zone_polygon(layer_stops_out, "выход")
+        # пересечение зон для получения общей доступности (по каждой полосе)
+        feedback.setProgressText(f"{prefix}этап 4: пересечение зон...")
+        with profiler.stage(f"{prefix}этап 4: пересечение зон", feedback) as record:
+            zones_inter = run_branches([overlay_branch("native:intersection", z_in, z_out)
+                                        for z_in, z_out in zip(zones_in, zones_out)],
+                                       context, feedback, threads, 60, 70)
+            record['features'] = len(zones_inter)
+        if feedback.isCanceled():
+            return []
         
-        if not zone_in or not zone_out:
-             raise QgsProcessingException("сбой при построении зон.")
-
-        # пересечение зон для получения общей доступности
-        feedback.setProgressText("этап 4: пересечение зон...")
-        zone_inter_dict = processing.run("native:intersection", {
-            'INPUT': zone_in,
-            'OVERLAY': zone_out,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback, is_child_algorithm=True)
-        zone_inter = get_layer_obj(zone_inter_dict['OUTPUT'])
+        # зоны по каждому порогу: [порог, вход, выход, пересечение]
+        bands = [list(band) for band in zip(thresholds, zones_in, zones_out, zones_inter)]
+
+        if settings['as_rings']:
+            # кольца: из каждой полосы вычитается предыдущая (по исходным вложенным полигонам)
+            ring_jobs = [(i, k) for i in range(1, len(bands)) for k in (1, 2, 3)
+                         if bands[i][k] and bands[i - 1][k]]
+            with profiler.stage(f"{prefix}кольца полос", feedback) as record:
+                rings = run_branches([overlay_branch("native:difference", bands[i][k], bands[i - 1][k])
+                                      for i, k in ring_jobs], context, feedback, threads, 70, 75)
+                record['features'] = len(rings)
+            if feedback.isCanceled():
+                return []
+            for (i, k), ring in zip(ring_jobs, rings):
+                bands[i][k] = ring
 
         # подсчет населения в зонах
-        feedback.setProgressText("этап 5: подсчет населения...")
-        pop_source = self.parameterAsSource(parameters, self.INPUT_BUILDINGS, context)
-        pop_field = self.parameterAsString(parameters, self.POPULATION_FIELD, context)
+        feedback.setProgressText(f"{prefix}этап 5: подсчет населения...")
 
         def calc_pop(zone_lyr, name):
-            if not zone_lyr: return None
-            total_pop = 0
-            
-            zone_iter = zone_lyr.getFeatures()
-            zone_feat = next(zone_iter, None)
-            
-            if zone_feat:
-                zone_geom = zone_feat.geometry()
+            if not zone_lyr: return lambda ctx, fb: None
+            zone_source, zone_fields, zone_type, zone_crs, _ = layer_snapshot(zone_lyr)
+            def run(ctx, fb):
+                # население считается для каждого объекта зоны и пишется одним пакетом
+                fields = QgsFields(zone_fields)
+                fields.append(QgsField('calc_pop', QVariant.Int))
+                res_lyr = QgsMemoryProviderUtils.createMemoryLayer(name, fields, zone_type, zone_crs)
                 
-                # используем пространственный индекс для быстрого поиска зданий
-                bld_idx = QgsSpatialIndex(pop_source.getFeatures(), feedback)
-                candidate_ids = bld_idx.intersects(zone_geom.boundingBox())
-                req = QgsFeatureRequest().setFilterFids(candidate_ids)
+                total_pop = 0
+                feats = []
+                with profiler.stage(f"население: {name}", fb) as record:
+                    for zone_feat in zone_source.getFeatures():
+                        if fb.isCanceled(): break
+                        pop = int(pop_index.count(zone_feat.geometry()))
+                        total_pop += pop
+                        out_f = QgsFeature(fields)
+                        out_f.setGeometry(zone_feat.geometry())
+                        out_f.setAttributes(zone_feat.attributes() + [pop])
+                        feats.append(out_f)
+                    record['features'] = len(feats)
+                res_lyr.dataProvider().addFeatures(feats)
+                ctx.temporaryLayerStore().addMapLayer(res_lyr)
                 
-                for bld in pop_source.getFeatures(req):
-                    if bld.geometry().intersects(zone_geom):
-                        val = bld[pop_field]
-                        if val: total_pop += val
-            
-            feedback.pushInfo(f"--- {name}: {int(total_pop)} чел. ---")
-            
-            # добавляем поле с рассчитанным населением
-            res_dict = processing.run("native:addfieldtoattributestable", {
-                'INPUT': zone_lyr,
-                'FIELD_NAME': 'calc_pop',
-                'FIELD_TYPE': 0, 
-                'FIELD_LENGTH': 10,
-                'OUTPUT': 'TEMPORARY_OUTPUT' 
-            }, context=context, feedback=feedback, is_child_algorithm=True)
-            
-            res_lyr = get_layer_obj(res_dict['OUTPUT'])
-            if res_lyr:
-                res_lyr.startEditing()
-                for f in res_lyr.getFeatures():
-                    res_lyr.changeAttributeValue(f.id(), res_lyr.fields().indexOf('calc_pop'), int(total_pop))
-                res_lyr.commitChanges()
-            return res_lyr
-
-        final_in = calc_pop(zone_in, "в район")
-        final_out = calc_pop(zone_out, "из района")
-        final_inter = calc_pop(zone_inter, "пересечение")
-
-        # сохранение результатов
+                fb.pushInfo(f"--- {name}: {int(total_pop)} чел. ---")
+                return res_lyr
+            return run
+
+        with profiler.stage(f"{prefix}этап 5: подсчет населения", feedback) as record:
+            pop_layers = run_branches([calc_pop(band[k], f"{prefix}{title} ({band[0]:g})")
+                                       for band in bands
+                                       for k, title in ((1, "в район"), (2, "из района"), (3, "пересечение"))],
+                                      context, feedback, threads, 80, 95)
+            record['features'] = sum(1 for layer in pop_layers if layer)
+        if feedback.isCanceled():
+            return []
+        return [(band[0],) + tuple(pop_layers[3 * i:3 * i + 3]) for i, band in enumerate(bands)]
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # индексы на диске, прочитанные за этот прогон
+        self.sidecar_arrays = {}
+        
+        # получаем параметры
+        w_crs = self.parameterAsVectorLayer(parameters, self.INPUT_GRAPH, context).sourceCrs()
+        profile_path = self.parameterAsFileOutput(parameters, self.PROFILE_OUTPUT, context)
+        profiler = StageProfiler(feedback)
+
+        settings = self.zone_settings(parameters, context)
+        
+        layer_stops_in = self.parameterAsVectorLayer(parameters, self.INPUT_STOPS_IN, context)
+        layer_stops_out = self.parameterAsVectorLayer(parameters, self.INPUT_STOPS_OUT, context)
+
+        if not layer_stops_in or not layer_stops_out:
+            raise QgsProcessingException("ошибка загрузки слоев остановок.")
+
+        # независимые ветки (вход/выход, пересечения по полосам, подсчет населения)
+        # выполняются в пуле потоков, у каждой ветки свой контекст обработки
+        threads = self.parameterAsInt(parameters, self.THREADS, context) or os.cpu_count() or 1
+
+        def stops_xy(stops_layer):
+            # координаты остановок в crs графа (читаются в основном потоке)
+            to_graph = QgsCoordinateTransform(stops_layer.crs(), w_crs, context.transformContext())
+            return point_xy(stops_layer.getFeatures(), to_graph)
+
+        xy_in, xy_out = stops_xy(layer_stops_in), stops_xy(layer_stops_out)
+        tile_size = self.parameterAsDouble(parameters, self.TILE_SIZE, context)
+        if tile_size > 0 or self.parameterAsBoolean(parameters, self.CLIP_TO_STOPS, context):
+            # ни один путь дешевле наибольшего порога не выходит за охват остановок с ореолом этого порога:
+            # вес ребра не меньше его длины; здания - еще с запасом на буфер зоны
+            halo = settings['thresholds'][-1]
+            tiles = stop_tiles(xy_in, xy_out, tile_size, halo)
+            if not tiles:
+                raise QgsProcessingException("ошибка: в слоях остановок нет точек.")
+            sources = []
+            for n, (rect, tile_in, tile_out) in enumerate(tiles):
+                feedback.pushInfo(f"тайл {n + 1} из {len(tiles)}: остановок {len(tile_in[0]) + len(tile_out[0])}, "
+                                  f"охват {rect.width():.0f} x {rect.height():.0f} м")
+                sources.append((self.load_graph(parameters, context, feedback, profiler, rect), tile_in, tile_out))
+                if feedback.isCanceled():
+                    return {}
+            pop_rect = QgsRectangle(tiles[0][0])
+            for rect, _, _ in tiles[1:]:
+                pop_rect.combineExtentWith(rect)
+            pop_rect = pop_rect.buffered(self.BUFFER_DISTANCE)
+        else:
+            sources = [(self.load_graph(parameters, context, feedback, profiler), xy_in, xy_out)]
+            pop_rect = None
+        if feedback.isCanceled():
+            return {}
+        feedback.setProgress(40)
+
+        pop_index = self.load_population(parameters, context, feedback, profiler, w_crs, pop_rect)
+        if feedback.isCanceled():
+            return {}
+        finals = self.district_zones(sources, w_crs, pop_index, settings, context, feedback, threads, profiler)
+        if feedback.isCanceled():
+            return {}
+
+        # сохранение результатов: по объекту на каждую полосу с ее порогом в cost_band
         results = {}
         outputs_map = [
-            (final_in, self.OUTPUT_LAYER_IN, "зона_вход"),
-            (final_out, self.OUTPUT_LAYER_OUT, "зона_выход"),
-            (final_inter, self.OUTPUT_INTERSECTION, "зона_общая")
+            (1, self.OUTPUT_LAYER_IN, "зона_вход"),
+            (2, self.OUTPUT_LAYER_OUT, "зона_выход"),
+            (3, self.OUTPUT_INTERSECTION, "зона_общая")
         ]
 
-        for layer, sink_name, debug_name in outputs_map:
-            if layer:
+        written = 0
+        with profiler.stage("запись результатов") as record:
+            for idx, sink_name, debug_name in outputs_map:
+                band_layers = [(final[0], final[idx]) for final in finals if final[idx]]
+                if not band_layers:
+                    continue
+                first_layer = band_layers[0][1]
+                fields = QgsFields(first_layer.fields())
+                fields.append(QgsField('cost_band', QVariant.Double))
                 (sink, dest_id) = self.parameterAsSink(parameters, sink_name, context,
-                                                       layer.fields(), layer.wkbType(), layer.sourceCrs())
+                                                       fields, QgsWkbTypes.multiType(first_layer.wkbType()),
+                                                       first_layer.sourceCrs())
                 if sink:
-                    sink.addFeatures(layer.getFeatures(), QgsFeatureSink.FastInsert)
+                    for cost, layer in band_layers:
+                        for f in layer.getFeatures():
+                            geom = f.geometry()
+                            geom.convertToMultiType()
+                            out_f = QgsFeature(fields)
+                            out_f.setGeometry(geom)
+                            out_f.setAttributes(f.attributes() + [cost])
+                            sink.addFeature(out_f, QgsFeatureSink.FastInsert)
+                            written += 1
                     results[sink_name] = dest_id
-                    
+                
                     # для отладки можно добавить слои на карту
                     stored_lyr = QgsProcessingUtils.mapLayerFromString(dest_id, context)
                     if stored_lyr:
                         stored_lyr.setName(debug_name)
+            record['features'] = written
+
+        profile = profiler.report()
+        feedback.pushInfo(f"профиль: всего {profile['total_seconds']:.2f} с, записано объектов: {written}")
+        if profile_path:
+            profiler.save(profile_path)
+            results[self.PROFILE_OUTPUT] = profile_path
+
+        return results
 
-        return results
\ No newline at end of file
@@ -4,8 +4,653 @@ from qgis.core import QgsProcessingParameterFeatureSource
 from qgis.core import QgsProcessingParameterField
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingOutputString
+from qgis.core import QgsProcessingParameterVectorLayer
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsProcessingFeatureSourceDefinition
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProviderRegistry
+from qgis.core import QgsVectorDataProvider
+from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsFeature
+from qgis.core import QgsFeatureRequest
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsFeatureSource
+from qgis.core import QgsField
+from qgis.core import QgsFields
+from qgis.core import QgsGeometry
+from qgis.core import QgsPointXY
+from qgis.core import QgsRectangle
+from qgis.core import QgsVectorFileWriter
+from qgis.core import QgsWkbTypes
+from qgis.core import QgsSpatialIndex
+from qgis.PyQt.QtCore import QVariant
 import processing
 
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def parse_numbers(text, invalid_message, negative_message):
+    # положительные числа из строки вида "1.5, 2; 2.5" - по возрастанию, без повторов
+    try:
+        values = {float(token) for token in re.split(r'[;,\s]+', text or '') if token}
+    except ValueError:
+        raise QgsProcessingException(f"{invalid_message}: {text}")
+    if any(v <= 0 for v in values):
+        raise QgsProcessingException(negative_message)
+    return sorted(values)
+
+
+def parse_ratios(text):
+    # список коэффициентов для сценариев
+    return parse_numbers(text, "Неверный список коэффициентов", "Коэффициенты должны быть положительными")
+
+
+def scenario_columns(ratios):
+    # поле дефицита для каждого сценария: 2.5 -> Deficit_2_5
+    return [('Deficit_' + f'{r:g}'.replace('.', '_'), r) for r in ratios]
+
+
+def deficit_table(parking_sum, parking_hits, pop_sum, pop_hits, ratio, scenarios):
+    # дефицит по всем ячейкам для основного коэффициента (число или массив по ячейкам)
+    # и для каждого сценария; nan - NULL (в ячейке нет парковок или жителей)
+    valid = (parking_hits > 0) & (pop_hits > 0)
+    table = {}
+    for name, r in [('Deficit', ratio)] + scenarios:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            raw = pop_sum / r - parking_sum
+        # округление как при записи double в целое поле (половины - от нуля)
+        rounded = np.where(raw >= 0, np.floor(raw + 0.5), np.ceil(raw - 0.5))
+        table[name] = np.where(valid, rounded, np.nan)
+    return table
+
+
+def pyramid_sizes(text, cell_width, cell_height):
+    # размеры ячеек уровней пирамиды и кратность каждого размеру исходной ячейки по x и y
+    sizes = parse_numbers(text, "Неверный список размеров ячеек", "Размеры ячеек должны быть положительными")
+    levels = []
+    for size in sizes:
+        kx, ky = size / cell_width, size / cell_height
+        if min(kx, ky) < 1 or abs(kx - round(kx)) > 1e-6 * kx or abs(ky - round(ky)) > 1e-6 * ky:
+            raise QgsProcessingException(f"Размер {size:g} не кратен ячейке сетки {cell_width:g} x {cell_height:g}")
+        levels.append((size, int(round(kx)), int(round(ky))))
+    return levels
+
+
+def coarsen(parent, count, parking_sum, parking_hits, pop_sum, pop_hits, ratio):
+    # суммы уровня пирамиды из дочерних ячеек; коэффициент по ячейкам сводится так,
+    # чтобы потребность в местах крупной ячейки равнялась сумме потребностей дочерних
+    sums = [np.bincount(parent, weights=values, minlength=count)
+            for values in (parking_sum, parking_hits, pop_sum, pop_hits)]
+    if np.ndim(ratio):
+        need = np.bincount(parent, weights=pop_sum / ratio, minlength=count)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(need > 0, sums[2] / need, float(np.median(ratio)))
+    return sums + [ratio]
+
+
+def deficit_summary(table):
+    # итоги по сценарию: чистый дефицит, сумма дефицита в ячейках с нехваткой, число таких ячеек
+    return {name: {'net': float(np.nansum(values)),
+                   'shortage': float(np.nansum(np.clip(values, 0, None))),
+                   'cells_short': int(np.count_nonzero(values > 0))}
+            for name, values in table.items()}
+
+
+def table_value(table, name, i):
+    value = table[name][i]
+    return None if np.isnan(value) else int(value)
+
+
+def feature_signatures(source, field, feedback=None):
+    # подписи объектов (crc32 геометрии и значения поля) для поиска изменений между прогонами
+    req = QgsFeatureRequest().setSubsetOfAttributes([field], source.fields())
+    fids, sigs = array('q'), array('q')
+    for f in source.getFeatures(req):
+        if feedback and feedback.isCanceled():
+            break
+        geom = f.geometry()
+        sig = zlib.crc32(repr(f[field]).encode())
+        fids.append(f.id())
+        sigs.append(zlib.crc32(bytes(geom.asWkb()) if geom else b'', sig))
+    return np.frombuffer(fids, dtype=np.int64), np.frombuffer(sigs, dtype=np.int64)
+
+
+def edit_buffer_fids(layer):
+    # объекты, затронутые несохраненными правками слоя: добавленные, измененные и удаленные
+    buffer = layer.editBuffer() if layer is not None and layer.isEditable() else None
+    if buffer is None:
+        return np.empty(0, dtype=np.int64)
+    fids = set(buffer.addedFeatures()) | set(buffer.changedGeometries()) | set(buffer.changedAttributeValues())
+    fids.update(buffer.deletedFeatureIds())
+    return np.array(sorted(fids), dtype=np.int64)
+
+
+def radius_pairs(ax, ay, bx, by, radius):
+    # все пары (i из a, j из b) на расстоянии не больше radius, без циклов по объектам:
+    # kd-дерево scipy, при его отсутствии - хэш-сетка с шагом radius и 9 соседних ячеек
+    if not len(ax) or not len(bx):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if cKDTree is not None:
+        tree_a = cKDTree(np.column_stack([ax, ay]))
+        tree_b = cKDTree(np.column_stack([bx, by]))
+        found = tree_a.sparse_distance_matrix(tree_b, radius, output_type='ndarray')
+        return found['i'].astype(np.int64), found['j'].astype(np.int64)
+
+    x0, y0 = min(ax.min(), bx.min()), min(ay.min(), by.min())
+    kax, kay = ((ax - x0) // radius).astype(np.int64), ((ay - y0) // radius).astype(np.int64)
+    kbx, kby = ((bx - x0) // radius).astype(np.int64), ((by - y0) // radius).astype(np.int64)
+    span = int(max(kay.max(), kby.max())) + 3
+    key_b = (kbx + 1) * span + (kby + 1)
+    order = np.argsort(key_b, kind='stable')
+    sorted_keys = key_b[order]
+    found_a, found_b = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            target = (kax + 1 + dx) * span + (kay + 1 + dy)
+            lo = np.searchsorted(sorted_keys, target, side='left')
+            counts = np.searchsorted(sorted_keys, target, side='right') - lo
+            ia = np.repeat(np.arange(len(ax)), counts)
+            offsets = np.arange(len(ia)) - np.repeat(np.cumsum(counts) - counts, counts)
+            jb = order[np.repeat(lo, counts) + offsets]
+            near = (ax[ia] - bx[jb]) ** 2 + (ay[ia] - by[jb]) ** 2 <= radius * radius
+            found_a.append(ia[near])
+            found_b.append(jb[near])
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+
+def catchment_totals(buildings, parking, radius, cell_count):
+    # спрос зданий обслуживается парковками в радиусе пешей доступности:
+    # места каждой парковки делятся между зданиями в радиусе пропорционально числу жителей,
+    # места, рядом с которыми нет жильцов, остаются в ячейке самой парковки;
+    # результат - суммы мест и жителей по ячейкам (как у обычной привязки)
+    bx, by, pop, b_cell = buildings
+    px, py, capacity, p_cell = parking
+    ib, ip = radius_pairs(bx, by, px, py, radius)
+    demand = np.bincount(ip, weights=pop[ib], minlength=len(px))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(demand[ip] > 0, capacity[ip] * pop[ib] / demand[ip], 0.0)
+    received = np.bincount(ib, weights=share, minlength=len(bx))
+    served = np.bincount(ib, minlength=len(bx)) > 0
+    unused = demand <= 0
+
+    in_b, in_p = b_cell >= 0, p_cell >= 0
+    parking_sum = (np.bincount(b_cell[in_b], weights=received[in_b], minlength=cell_count)
+                   + np.bincount(p_cell[in_p & unused], weights=capacity[in_p & unused], minlength=cell_count))
+    parking_hits = (np.bincount(b_cell[in_b & served], minlength=cell_count)
+                    + np.bincount(p_cell[in_p & unused], minlength=cell_count))
+    pop_sum = np.bincount(b_cell[in_b], weights=pop[in_b], minlength=cell_count)
+    pop_hits = np.bincount(b_cell[in_b], minlength=cell_count)
+    return parking_sum, parking_hits, pop_sum, pop_hits
+
+
+def peak_rss():
+    # пиковая память процесса в байтах (ru_maxrss: linux - кб, macos - байты); None без модуля resource
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class StageProfiler:
+    # замер этапов и дочерних алгоритмов: время, число объектов, пиковая память процесса
+
+    def __init__(self, feedback=None):
+        self.feedback = feedback
+        self.records = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, feedback=None, kind='stage'):
+        # record['features'] заполняет вызывающий код
+        record = {'name': name, 'kind': kind, 'features': None}
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['start'] = round(start - self._started, 4)
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['peak_rss'] = peak_rss()
+            record['rss_growth'] = record['peak_rss'] - rss_before if rss_before is not None else None
+            with self._lock:
+                self.records.append(record)
+            fb = feedback or self.feedback
+            if fb:
+                fb.pushInfo(self.describe(record))
+
+    def run(self, alg_id, params, context, feedback):
+        # дочерний алгоритм с замером; число объектов - у его выходного слоя
+        with self.stage(alg_id, feedback, kind='child') as record:
+            result = processing.run(alg_id, params, context=context, feedback=feedback, is_child_algorithm=True)
+            output = result.get('OUTPUT')
+            if isinstance(output, str):
+                output = QgsProcessingUtils.mapLayerFromString(output, context)
+            if output is not None and hasattr(output, 'featureCount'):
+                record['features'] = output.featureCount()
+        return result
+
+    @staticmethod
+    def describe(record):
+        text = f"Профиль: {record['name']} - {record['seconds']:.2f} с"
+        if record['features'] is not None:
+            text += f", объектов: {record['features']}"
+        if record['peak_rss'] is not None:
+            text += f", пик памяти: {record['peak_rss'] / 2 ** 20:.0f} МБ"
+        return text
+
+    def report(self):
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r['start'])
+        return {'total_seconds': round(time.perf_counter() - self._started, 4),
+                'peak_rss': peak_rss(), 'stages': records}
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+
+class DeficitState:
+    # состояние инкрементального расчета рядом с файлом слоя результата:
+    # подписи объектов источников, их пары (объект, ячейка, значение)
+    # и объекты из буфера правок на момент прошлого прогона
+
+    VERSION = 2
+    SOURCES = ('parking', 'pop')
+    ARRAYS = ('sig_fids', 'sigs', 'pair_fids', 'pair_cells', 'pair_values', 'buffer_fids')
+
+    def __init__(self, path, meta, cell_fids, arrays=None):
+        self.path = path
+        self.meta = meta
+        self.cell_fids = np.asarray(cell_fids, dtype=np.int64)
+        empty = {'sig_fids': np.empty(0, dtype=np.int64), 'sigs': np.empty(0, dtype=np.int64),
+                 'pair_fids': np.empty(0, dtype=np.int64), 'pair_cells': np.empty(0, dtype=np.int64),
+                 'pair_values': np.empty(0), 'buffer_fids': np.empty(0, dtype=np.int64)}
+        self.arrays = arrays or {key: dict(empty) for key in self.SOURCES}
+
+    @staticmethod
+    def path_for(layer):
+        # путь состояния для файлового слоя; None, если слой не в файле
+        parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        path = parts.get('path')
+        if not path or not os.path.isfile(path):
+            return None
+        return f"{path}.{parts.get('layerName') or layer.name()}.deficit_state.npz"
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                if meta.get('version') != cls.VERSION:
+                    return None
+                arrays = {key: {name: data[f'{key}_{name}'] for name in cls.ARRAYS} for key in cls.SOURCES}
+                return cls(path, meta, data['cell_fids'], arrays)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self):
+        data = {f'{key}_{name}': self.arrays[key][name] for key in self.SOURCES for name in self.ARRAYS}
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, meta=np.array(json.dumps(self.meta)), cell_fids=self.cell_fids, **data)
+        os.replace(tmp_path, self.path)
+
+
+def file_stamp(path):
+    # штамп файла данных: размер и время изменения (у GeoPackage - и журнала wal)
+    stamp = []
+    for p in (path, path + '-wal'):
+        if os.path.exists(p):
+            st = os.stat(p)
+            stamp += [st.st_size, st.st_mtime_ns]
+    return stamp
+
+
+def layer_stamp(layer):
+    # штамп файла слоя вместе с фильтром слоя; None, если слой не в файле
+    parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+    path = parts.get('path')
+    if not path or not os.path.isfile(path):
+        return None
+    return [layer.subsetString()] + file_stamp(path)
+
+
+def crs_key(crs):
+    return crs.authid() or crs.toWkt()
+
+
+def ensure_spatial_index(layer):
+    # у файлов без встроенного индекса (Shapefile) создается .qix для выборок по охвату
+    provider = layer.dataProvider()
+    if (provider.hasSpatialIndex() == QgsFeatureSource.SpatialIndexNotPresent
+            and provider.capabilities() & QgsVectorDataProvider.CreateSpatialIndex):
+        provider.createSpatialIndex()
+
+
+class IndexSidecar:
+    # постоянный индекс большого статичного слоя - массивы npz рядом с файлом слоя
+    # (во временной папке, если папка слоя только для чтения);
+    # действителен, пока не изменились штамп файла и ключ (поля, crs, параметры)
+
+    VERSION = 1
+    CACHE_DIR = '.index_cache'
+
+    def __init__(self, path, stamp, key):
+        self.path = path
+        self.meta = {'stamp': stamp, 'key': key}
+
+    @classmethod
+    def for_layer(cls, layer, kind, key):
+        # None, если слой не в файле
+        if layer is None:
+            return None
+        parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+        data_path = parts.get('path')
+        if not data_path or not os.path.isfile(data_path):
+            return None
+        ensure_spatial_index(layer)
+        name = f"{os.path.basename(data_path)}.{parts.get('layerName') or layer.name()}.{kind}.idx.npz"
+        folder = os.path.dirname(data_path)
+        if os.access(folder, os.W_OK):
+            path = os.path.join(folder, name)
+        else:
+            digest = hashlib.sha1(data_path.encode()).hexdigest()[:12]
+            path = os.path.join(tempfile.gettempdir(), cls.CACHE_DIR, f"{digest}.{name}")
+        return cls(path, file_stamp(data_path), [cls.VERSION, layer.subsetString()] + list(key))
+
+    def load(self):
+        # массивы индекса или None, если его нет или он устарел
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path) as data:
+                if json.loads(str(data['meta'])) != self.meta:
+                    return None
+                return {name: data[name] for name in data.files if name != 'meta'}
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, arrays):
+        # индекс - дополнительная оптимизация: ошибка записи не прерывает расчет
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp.npz'
+            np.savez(tmp_path, meta=np.array(json.dumps(self.meta)), **arrays)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+class GridBinner:
+    # привязка объектов к ячейкам сетки по предикату "пересекает":
+    # у регулярной сетки номер ячейки считается по координатам,
+    # у нерегулярной - через пространственный индекс ячеек
+
+    # допуск проверки регулярности, доля размера ячейки
+    TOLERANCE = 1e-6
+    # регулярная сетка с большим числом пустых мест в прямоугольнике считается нерегулярной
+    MAX_SPARSITY = 4
+
+    def __init__(self, grid_source, feedback=None, sidecar=None):
+        # sidecar - индекс ячеек на диске (id, охваты и wkb геометрий), геометрии разбираются по мере надобности
+        self.crs = grid_source.sourceCrs()
+        stored = sidecar.load() if sidecar else None
+        if stored is None:
+            stored = self.read_cells(grid_source, feedback)
+            if sidecar and not (feedback and feedback.isCanceled()):
+                sidecar.save(stored)
+        elif feedback:
+            feedback.pushInfo(f"Индекс сетки загружен: {sidecar.path}")
+        self.fids = stored['fids'].tolist()
+        self.bounds = np.asarray(stored['bounds'], dtype=float).reshape(-1, 5)
+        self.wkb, self.offsets = stored['wkb'], stored['offsets']
+        self.geoms = {}
+        self.position = {fid: i for i, fid in enumerate(self.fids)}
+        self.lookup = None
+        self.index = None
+        if not self._detect_regular():
+            self.index = QgsSpatialIndex()
+            for i, (xmin, ymin, xmax, ymax, _) in enumerate(self.bounds.tolist()):
+                self.index.addFeature(i, QgsRectangle(xmin, ymin, xmax, ymax))
+
+    @staticmethod
+    def read_cells(grid_source, feedback=None):
+        fids, bounds, chunks, offsets = array('q'), array('d'), [], [0]
+        for f in grid_source.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if feedback and feedback.isCanceled():
+                break
+            geom = f.geometry()
+            rect = geom.boundingBox()
+            fids.append(f.id())
+            bounds.extend((rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum(), geom.area()))
+            chunks.append(bytes(geom.asWkb()))
+            offsets.append(offsets[-1] + len(chunks[-1]))
+        return {'fids': np.frombuffer(fids, dtype=np.int64), 'bounds': np.frombuffer(bounds, dtype=float),
+                'wkb': np.frombuffer(b''.join(chunks), dtype=np.uint8), 'offsets': np.asarray(offsets, dtype=np.int64)}
+
+    def arrays(self):
+        return {'fids': np.asarray(self.fids, dtype=np.int64), 'bounds': self.bounds,
+                'wkb': self.wkb, 'offsets': self.offsets}
+
+    def geometry(self, i):
+        geom = self.geoms.get(i)
+        if geom is None:
+            geom = QgsGeometry()
+            geom.fromWkb(self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes())
+            self.geoms[i] = geom
+        return geom
+
+    def __len__(self):
+        return len(self.fids)
+
+    @property
+    def regular(self):
+        return self.lookup is not None
+
+    def _detect_regular(self):
+        # сетка регулярна, если все ячейки - одинаковые прямоугольники, выровненные по общему началу
+        if not len(self.fids):
+            return False
+        xmin, ymin, xmax, ymax, area = self.bounds.T
+        width, height = xmax - xmin, ymax - ymin
+        cw, ch = float(np.median(width)), float(np.median(height))
+        if cw <= 0 or ch <= 0:
+            return False
+        tol_x, tol_y = self.TOLERANCE * cw, self.TOLERANCE * ch
+        if np.any(np.abs(width - cw) > tol_x) or np.any(np.abs(height - ch) > tol_y):
+            return False
+        if np.any(np.abs(area - width * height) > self.TOLERANCE * cw * ch):
+            return False
+        x0, y1 = float(xmin.min()), float(ymax.max())
+        cols_f, rows_f = (xmin - x0) / cw, (y1 - ymax) / ch
+        cols, rows = np.rint(cols_f).astype(np.int64), np.rint(rows_f).astype(np.int64)
+        if np.any(np.abs(cols_f - cols) > self.TOLERANCE) or np.any(np.abs(rows_f - rows) > self.TOLERANCE):
+            return False
+        n_rows, n_cols = int(rows.max()) + 1, int(cols.max()) + 1
+        if n_rows * n_cols > self.MAX_SPARSITY * len(self.fids) + 1000000:
+            return False
+        lookup = np.full((n_rows, n_cols), -1, dtype=np.int64)
+        lookup[rows, cols] = np.arange(len(self.fids))
+        if np.count_nonzero(lookup >= 0) != len(self.fids):
+            # ячейки-дубликаты
+            return False
+        self.lookup = lookup
+        self.x0, self.y1 = x0, y1
+        self.cell_width, self.cell_height = cw, ch
+        self.rows, self.cols = rows, cols
+        return True
+
+    def candidates(self, rect):
+        # ячейки, пересекающие прямоугольник; второй результат - лежит ли он целиком в одной ячейке
+        if self.lookup is None:
+            return self.index.intersects(rect), False
+        n_rows, n_cols = self.lookup.shape
+        c0 = int(math.floor((rect.xMinimum() - self.x0) / self.cell_width))
+        c1 = int(math.floor((rect.xMaximum() - self.x0) / self.cell_width))
+        r0 = int(math.floor((self.y1 - rect.yMaximum()) / self.cell_height))
+        r1 = int(math.floor((self.y1 - rect.yMinimum()) / self.cell_height))
+        # одна ячейка - только если прямоугольник целиком в ней, а не за краем сетки
+        single = c0 == c1 and r0 == r1
+        c0, c1 = max(c0, 0), min(c1, n_cols - 1)
+        r0, r1 = max(r0, 0), min(r1, n_rows - 1)
+        if c0 > c1 or r0 > r1:
+            return [], False
+        block = self.lookup[r0:r1 + 1, c0:c1 + 1]
+        return block[block >= 0].tolist(), single
+
+    def cells_for(self, geom, weighted=False):
+        # ячейки, которые пересекает геометрия, с долей объекта в каждой:
+        # weighted=False - объект целиком в каждой ячейке, True - доля по площади (длине) пересечения
+        if not geom or geom.isEmpty():
+            return []
+        cells, single = self.candidates(geom.boundingBox())
+        if not cells:
+            return []
+        if single:
+            # объект целиком внутри одной ячейки - без геометрических проверок
+            return [(cells[0], 1.0)]
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        hits = [c for c in cells if engine.intersects(self.geometry(c).constGet())]
+        if not weighted or len(hits) <= 1:
+            return [(c, 1.0) for c in hits]
+        dim = QgsWkbTypes.geometryType(geom.wkbType())
+        measure = (lambda g: g.area()) if dim == QgsWkbTypes.PolygonGeometry else (lambda g: g.length())
+        total = measure(geom)
+        if dim == QgsWkbTypes.PointGeometry or total <= 0:
+            return [(c, 1.0 / len(hits)) for c in hits]
+        # часть объекта за пределами сетки ни в одну ячейку не попадает
+        parts = [(c, measure(QgsGeometry(engine.intersection(self.geometry(c).constGet())))) for c in hits]
+        return [(c, m / total) for c, m in parts if m > 0]
+
+    def pairs(self, source, field, context, feedback=None, fids_filter=None, weighted=False, sidecar=None):
+        # один проход по слою: пары (id объекта, ячейка, значение поля с учетом доли объекта в ячейке);
+        # fids_filter - только указанные объекты; sidecar - готовые пары на диске (только без фильтра)
+        stored = sidecar.load() if sidecar and fids_filter is None else None
+        if stored is not None:
+            return stored['fids'], stored['cells'], stored['values']
+        result = self._pairs(source, field, context, feedback, fids_filter, weighted)
+        if sidecar and fids_filter is None and not (feedback and feedback.isCanceled()):
+            sidecar.save(dict(zip(('fids', 'cells', 'values'), result)))
+        return result
+
+    def _pairs(self, source, field, context, feedback, fids_filter, weighted):
+        req = QgsFeatureRequest().setSubsetOfAttributes([field], source.fields())
+        req.setDestinationCrs(self.crs, context.transformContext())
+        total = max(source.featureCount(), 1)
+        if fids_filter is not None:
+            req.setFilterFids([int(fid) for fid in fids_filter])
+            total = max(len(fids_filter), 1)
+        fids, cells, values = array('q'), array('q'), array('d')
+        if fids_filter is not None and not len(fids_filter):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        for i, f in enumerate(source.getFeatures(req)):
+            if feedback and i % 10000 == 0:
+                if feedback.isCanceled():
+                    break
+                feedback.setProgress(100 * i / total)
+            val = f[field]
+            val = float(val) if val is not None else 0.0
+            for cell, weight in self.cells_for(f.geometry(), weighted):
+                fids.append(f.id())
+                cells.append(cell)
+                values.append(val * weight)
+        return (np.frombuffer(fids, dtype=np.int64), np.frombuffer(cells, dtype=np.int64),
+                np.frombuffer(values, dtype=float))
+
+    def parents(self, kx, ky):
+        # номер родительской ячейки уровня с кратностью kx x ky для каждой ячейки регулярной сетки,
+        # а также строка и столбец каждого родителя
+        prow, pcol = self.rows // ky, self.cols // kx
+        key = prow * (int(pcol.max()) + 1) + pcol
+        keys, parent = np.unique(key, return_inverse=True)
+        first = np.zeros(len(keys), dtype=np.int64)
+        first[parent] = np.arange(len(parent))
+        return parent, prow[first], pcol[first]
+
+    def point_cells(self, xs, ys):
+        # ячейка для каждой точки (-1 - вне сетки): у регулярной сетки - арифметикой по массивам
+        if self.lookup is not None:
+            n_rows, n_cols = self.lookup.shape
+            cols = np.floor((xs - self.x0) / self.cell_width).astype(np.int64)
+            rows = np.floor((self.y1 - ys) / self.cell_height).astype(np.int64)
+            inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+            cells = np.full(len(xs), -1, dtype=np.int64)
+            cells[inside] = self.lookup[rows[inside], cols[inside]]
+            return cells
+        cells = np.full(len(xs), -1, dtype=np.int64)
+        for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            point = QgsGeometry.fromPointXY(QgsPointXY(x, y))
+            for c in self.index.intersects(point.boundingBox()):
+                if self.geometry(c).intersects(point):
+                    cells[i] = c
+                    break
+        return cells
+
+    def centroids(self, source, field, context, feedback=None, sidecar=None):
+        # центроиды объектов в crs сетки, значения поля и ячейки центроидов;
+        # sidecar - центроиды и значения на диске, ячейки пересчитываются по сетке
+        stored = sidecar.load() if sidecar else None
+        if stored is not None:
+            return stored['xs'], stored['ys'], stored['values'], self.point_cells(stored['xs'], stored['ys'])
+        xs, ys, values = self._centroids(source, field, context, feedback)
+        if sidecar and not (feedback and feedback.isCanceled()):
+            sidecar.save({'xs': xs, 'ys': ys, 'values': values})
+        return xs, ys, values, self.point_cells(xs, ys)
+
+    def _centroids(self, source, field, context, feedback):
+        req = QgsFeatureRequest().setSubsetOfAttributes([field], source.fields())
+        req.setDestinationCrs(self.crs, context.transformContext())
+        xs, ys, values = array('d'), array('d'), array('d')
+        for f in source.getFeatures(req):
+            if feedback and feedback.isCanceled():
+                break
+            geom = f.geometry()
+            if not geom or geom.isEmpty():
+                continue
+            point = geom.centroid().asPoint()
+            val = f[field]
+            xs.append(point.x())
+            ys.append(point.y())
+            values.append(float(val) if val is not None else 0.0)
+        return np.frombuffer(xs, dtype=float), np.frombuffer(ys, dtype=float), np.frombuffer(values, dtype=float)
+
+    def totals(self, cells, values):
+        # суммы по ячейкам и число попавших объектов (0 - в ячейке ничего нет, сумма NULL)
+        sums = np.bincount(cells, weights=values, minlength=len(self))
+        hits = np.bincount(cells, minlength=len(self))
+        return sums, hits
+
+
 class ParkingDeficitAnalyzer(QgsProcessingAlgorithm):
 
     INPUT_GRID = 'INPUT_GRID'
@@ -14,6 +659,16 @@ class ParkingDeficitAnalyzer(QgsProcessingAlgorithm):
     FIELD_CAPACITY = 'FIELD_CAPACITY'
     FIELD_POPULATION = 'FIELD_POPULATION'
     FIELD_RATIO = 'FIELD_RATIO'
+    METHOD = 'METHOD'
+    INCREMENTAL_LAYER = 'INCREMENTAL_LAYER'
+    FIELD_RATIOS = 'FIELD_RATIOS'
+    RATIO_FIELD = 'RATIO_FIELD'
+    CATCHMENT_RADIUS = 'CATCHMENT_RADIUS'
+    ALLOCATION = 'ALLOCATION'
+    PYRAMID_SIZES = 'PYRAMID_SIZES'
+    PYRAMID_OUTPUT = 'PYRAMID_OUTPUT'
+    PROFILE_OUTPUT = 'PROFILE_OUTPUT'
+    SUMMARY = 'SUMMARY'
     OUTPUT_LAYER = 'OUTPUT_LAYER'
 
 
@@ -69,27 +724,472 @@ class ParkingDeficitAnalyzer(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.FIELD_RATIOS,
+                self.tr('Сценарии: коэффициенты через запятую, напр. 1.5,2,2.5,3 (поле Deficit_<коэф.>)'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.RATIO_FIELD,
+                self.tr('Поле коэффициента в сетке (вместо общего значения)'),
+                parentLayerParameterName=self.INPUT_GRID,
+                type=QgsProcessingParameterField.Numeric,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.ALLOCATION,
+                self.tr('Объект на границе ячеек'),
+                options=[self.tr('Учитывать целиком в каждой ячейке'),
+                         self.tr('Делить пропорционально площади пересечения')],
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CATCHMENT_RADIUS,
+                self.tr('Радиус пешей доступности парковки, м (0 - только своя ячейка)'),
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.METHOD,
+                self.tr('Способ агрегации'),
+                options=[self.tr('Быстрый (регулярная сетка / пространственный индекс)'),
+                         self.tr('Пространственное соединение (native)')],
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INCREMENTAL_LAYER,
+                self.tr('Обновить готовый слой дефицита (только измененные ячейки)'),
+                [QgsProcessing.Type.VectorPolygon],
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT_LAYER,
-                self.tr('Финальный слой')
+                self.tr('Финальный слой'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.PYRAMID_SIZES,
+                self.tr('Пирамида: размеры крупных ячеек через запятую, кратные ячейке сетки, напр. 250,500,1000'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.PYRAMID_OUTPUT,
+                self.tr('Пирамида дефицита (все уровни в одном GeoPackage)'),
+                self.tr('GeoPackage (*.gpkg)'),
+                optional=True,
+                createByDefault=False
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.PROFILE_OUTPUT,
+                self.tr('Профиль этапов (JSON)'),
+                self.tr('JSON (*.json)'),
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        self.addOutput(
+            QgsProcessingOutputString(
+                self.SUMMARY,
+                self.tr('Итоги по сценариям (JSON)')
+            )
+        )
+
+    def whole_layer(self, parameters, name, context):
+        # слой входа, если он берется целиком, без выборки, лимита и фильтра
+        value = parameters.get(name)
+        if isinstance(value, QgsProcessingFeatureSourceDefinition) and (
+                value.selectedFeaturesOnly or value.featureLimit != -1 or getattr(value, 'filterExpression', '')):
+            return None
+        return self.parameterAsVectorLayer(parameters, name, context)
+
+    def static_layer(self, parameters, name, context):
+        # слой входа для индекса на диске; несохраненные правки не меняют штамп файла,
+        # поэтому редактируемый слой читается заново
+        layer = self.whole_layer(parameters, name, context)
+        if layer is not None and layer.isEditable() and layer.isModified():
+            return None
+        return layer
+
     def processAlgorithm(self, parameters, context, feedback):
         feedback.pushInfo("--- Запуск анализа дефицита парковок ---")
+        profiler = StageProfiler(feedback)
+        results = self.analyze(parameters, context, feedback, profiler)
 
-        parking_field = self.parameterAsFields(parameters, self.FIELD_CAPACITY, self.INPUT_PARKING)[0]
-        pop_field = self.parameterAsFields(parameters, self.FIELD_POPULATION, self.INPUT_BUILDINGS)[0]
-        ratio = parameters[self.FIELD_RATIO]
-        
+        profile = profiler.report()
+        feedback.pushInfo(f"Профиль: всего {profile['total_seconds']:.2f} с")
+        profile_path = self.parameterAsFileOutput(parameters, self.PROFILE_OUTPUT, context)
+        if profile_path:
+            profiler.save(profile_path)
+            results[self.PROFILE_OUTPUT] = profile_path
+        return results
+
+    def analyze(self, parameters, context, feedback, profiler):
+        # выбор способа расчета и быстрый способ по сетке
+
+        parking_field = self.parameterAsFields(parameters, self.FIELD_CAPACITY, context)[0]
+        pop_field = self.parameterAsFields(parameters, self.FIELD_POPULATION, context)[0]
+        ratio = self.parameterAsDouble(parameters, self.FIELD_RATIO, context)
+        # все сценарии считаются по одним и тем же суммам: соединения от коэффициента не зависят
+        scenarios = scenario_columns(parse_ratios(self.parameterAsString(parameters, self.FIELD_RATIOS, context)))
+        ratio_field = self.parameterAsString(parameters, self.RATIO_FIELD, context)
+        radius = self.parameterAsDouble(parameters, self.CATCHMENT_RADIUS, context)
+        weighted = self.parameterAsEnum(parameters, self.ALLOCATION, context) == 1
+        pyramid_path = self.parameterAsFileOutput(parameters, self.PYRAMID_OUTPUT, context)
+        pyramid_text = self.parameterAsString(parameters, self.PYRAMID_SIZES, context)
+        if pyramid_path and (self.parameterAsEnum(parameters, self.METHOD, context) == 1
+                             or self.parameterAsVectorLayer(parameters, self.INCREMENTAL_LAYER, context)):
+            raise QgsProcessingException("Пирамида строится только быстрым способом агрегации без обновления слоя")
+
+        if self.parameterAsEnum(parameters, self.METHOD, context) == 1:
+            if radius > 0 or weighted:
+                raise QgsProcessingException("Радиус доступности и деление по площади поддерживаются только быстрым способом агрегации")
+            return self.run_joins(parameters, context, feedback, profiler, parking_field, pop_field,
+                                  ratio, scenarios, ratio_field)
+
+        target_layer = self.parameterAsVectorLayer(parameters, self.INCREMENTAL_LAYER, context)
+        if target_layer:
+            if radius > 0:
+                # распределение мест зависит от соседей, изменения не локальны
+                raise QgsProcessingException("Радиус доступности не поддерживается в инкрементальном режиме")
+            return self.run_incremental(parameters, context, feedback, profiler, target_layer, parking_field, pop_field,
+                                        ratio, scenarios, ratio_field, weighted)
+
+        grid_source = self.parameterAsSource(parameters, self.INPUT_GRID, context)
+        parking_source = self.parameterAsSource(parameters, self.INPUT_PARKING, context)
+        buildings_source = self.parameterAsSource(parameters, self.INPUT_BUILDINGS, context)
+        steps = QgsProcessingMultiStepFeedback(3, feedback)
+
+        feedback.pushInfo("Разметка ячеек сетки")
+        # индексы статичных слоев хранятся рядом с их файлами и проверяются по времени изменения;
+        # привязка объектов к ячейкам зависит и от сетки, поэтому ключ включает штамп индекса сетки
+        grid_sidecar = IndexSidecar.for_layer(self.static_layer(parameters, self.INPUT_GRID, context), 'grid',
+                                              [crs_key(grid_source.sourceCrs())])
+        grid_key = [grid_sidecar.path, grid_sidecar.meta] if grid_sidecar else None
+
+        def sidecar(name, kind, key):
+            if grid_key is None:
+                return None
+            return IndexSidecar.for_layer(self.static_layer(parameters, name, context), kind, key + grid_key)
+
+        with profiler.stage("Разметка ячеек сетки") as record:
+            binner = GridBinner(grid_source, feedback, grid_sidecar)
+            record['features'] = len(binner)
+        if binner.regular:
+            feedback.pushInfo(f"Сетка регулярная: {binner.lookup.shape[0]} x {binner.lookup.shape[1]}, "
+                              f"ячейка {binner.cell_width:g} x {binner.cell_height:g}")
+        else:
+            feedback.pushInfo("Сетка нерегулярная: поиск ячеек через пространственный индекс")
+        if pyramid_path and not binner.regular:
+            raise QgsProcessingException("Пирамида строится только для регулярной сетки")
+        levels = pyramid_sizes(pyramid_text, binner.cell_width, binner.cell_height) if pyramid_path else []
+
+        if radius > 0:
+            # места назначаются зданиям в радиусе, затем дефицит собирается по ячейкам зданий
+            feedback.pushInfo(f"Распределение мест ({parking_field}) по зданиям в радиусе {radius:g} м")
+            steps.setCurrentStep(0)
+            with profiler.stage("Центроиды парковок") as record:
+                parking_points = binner.centroids(parking_source, parking_field, context, steps,
+                                                  sidecar(self.INPUT_PARKING, 'centroids', [parking_field]))
+                record['features'] = len(parking_points[0])
+            steps.setCurrentStep(1)
+            with profiler.stage("Центроиды зданий") as record:
+                building_points = binner.centroids(buildings_source, pop_field, context, steps,
+                                                   sidecar(self.INPUT_BUILDINGS, 'centroids', [pop_field]))
+                record['features'] = len(building_points[0])
+            with profiler.stage("Распределение мест в радиусе"):
+                parking_sum, parking_hits, pop_sum, pop_hits = catchment_totals(
+                    building_points, parking_points, radius, len(binner))
+        else:
+            feedback.pushInfo(f"Расчет суммы парковочных мест ({parking_field})")
+            steps.setCurrentStep(0)
+            with profiler.stage("Привязка парковок к ячейкам") as record:
+                _, cells, values = binner.pairs(parking_source, parking_field, context, steps, weighted=weighted,
+                                                sidecar=sidecar(self.INPUT_PARKING, 'cells', [parking_field, weighted]))
+                parking_sum, parking_hits = binner.totals(cells, values)
+                record['features'] = len(cells)
+
+            feedback.pushInfo(f"Расчет суммы жителей ({pop_field})")
+            steps.setCurrentStep(1)
+            with profiler.stage("Привязка зданий к ячейкам") as record:
+                _, cells, values = binner.pairs(buildings_source, pop_field, context, steps, weighted=weighted,
+                                                sidecar=sidecar(self.INPUT_BUILDINGS, 'cells', [pop_field, weighted]))
+                pop_sum, pop_hits = binner.totals(cells, values)
+                record['features'] = len(cells)
+
+        feedback.pushInfo("Расчет дефицита")
+        steps.setCurrentStep(2)
+        with profiler.stage("Расчет дефицита") as record:
+            ratios = self.cell_ratios(grid_source, binner, ratio_field, ratio)
+            table = deficit_table(parking_sum, parking_hits, pop_sum, pop_hits, ratios, scenarios)
+            record['features'] = len(binner)
+        results = {self.SUMMARY: self.report_summary(table, feedback)}
+        if pyramid_path:
+            with profiler.stage("Пирамида") as record:
+                self.write_pyramid(pyramid_path, binner, levels, (parking_sum, parking_hits, pop_sum, pop_hits, ratios),
+                                   scenarios, parking_field, pop_field, context, feedback)
+                record['features'] = len(levels) + 1
+            results[self.PYRAMID_OUTPUT] = pyramid_path
+
+        fields = QgsFields(grid_source.fields())
+        fields.append(QgsField(parking_field + '_sum', QVariant.Double))
+        fields.append(QgsField(pop_field + '_sum', QVariant.Double))
+        for name in table:
+            fields.append(QgsField(name, QVariant.Int, len=10))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT_LAYER, context,
+                                               fields, grid_source.wkbType(), grid_source.sourceCrs())
+        if sink is None:
+            if pyramid_path:
+                return results
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT_LAYER))
+
+        # итоговый слой пишется за один проход по сетке
+        with profiler.stage("Запись слоя") as record:
+            written = 0
+            for f in grid_source.getFeatures():
+                if feedback.isCanceled():
+                    break
+                i = binner.position.get(f.id())
+                if i is None:
+                    values = [None] * (2 + len(table))
+                else:
+                    values = [float(parking_sum[i]) if parking_hits[i] else None,
+                              float(pop_sum[i]) if pop_hits[i] else None]
+                    values += [table_value(table, name, i) for name in table]
+                out_f = QgsFeature(fields)
+                out_f.setGeometry(f.geometry())
+                out_f.setAttributes(f.attributes() + values)
+                sink.addFeature(out_f, QgsFeatureSink.FastInsert)
+                written += 1
+            record['features'] = written
+
+        results[self.OUTPUT_LAYER] = dest_id
+        return results
+
+    def write_pyramid(self, path, binner, levels, totals, scenarios, parking_field, pop_field, context, feedback):
+        # уровни пирамиды из сумм исходной сетки: ячейка уровня - сумма дочерних ячеек,
+        # дефицит пересчитывается по суммам; все уровни - слои deficit_<размер>m одного GeoPackage
+        levels = [(binner.cell_width, 1, 1)] + [level for level in levels if level[1:] != (1, 1)]
+        fields = QgsFields()
+        fields.append(QgsField('row', QVariant.Int))
+        fields.append(QgsField('col', QVariant.Int))
+        fields.append(QgsField('cells', QVariant.Int))
+        fields.append(QgsField(parking_field + '_sum', QVariant.Double))
+        fields.append(QgsField(pop_field + '_sum', QVariant.Double))
+        for name in ['Deficit'] + [name for name, _ in scenarios]:
+            fields.append(QgsField(name, QVariant.Int, len=10))
+
+        for n, (level_size, kx, ky) in enumerate(levels):
+            if feedback.isCanceled():
+                break
+            parent, prow, pcol = binner.parents(kx, ky)
+            parking_sum, parking_hits, pop_sum, pop_hits, ratio = coarsen(parent, len(prow), *totals)
+            table = deficit_table(parking_sum, parking_hits, pop_sum, pop_hits, ratio, scenarios)
+            children = np.bincount(parent, minlength=len(prow))
+            layer_name = f'deficit_{level_size:g}m'
+            feedback.pushInfo(f"Пирамида: слой {layer_name}, {len(prow)} ячеек")
+
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            options.layerName = layer_name
+            options.actionOnExistingFile = (QgsVectorFileWriter.CreateOrOverwriteFile if n == 0
+                                            else QgsVectorFileWriter.CreateOrOverwriteLayer)
+            writer = QgsVectorFileWriter.create(path, fields, QgsWkbTypes.Polygon, binner.crs,
+                                                context.transformContext(), options)
+            if writer.hasError() != QgsVectorFileWriter.NoError:
+                raise QgsProcessingException(f"Не удалось записать {layer_name}: {writer.errorMessage()}")
+            width, height = binner.cell_width * kx, binner.cell_height * ky
+            for i in range(len(prow)):
+                x0 = binner.x0 + int(pcol[i]) * width
+                y1 = binner.y1 - int(prow[i]) * height
+                out_f = QgsFeature(fields)
+                out_f.setGeometry(QgsGeometry.fromRect(QgsRectangle(x0, y1 - height, x0 + width, y1)))
+                out_f.setAttributes([int(prow[i]), int(pcol[i]), int(children[i]),
+                                     float(parking_sum[i]) if parking_hits[i] else None,
+                                     float(pop_sum[i]) if pop_hits[i] else None]
+                                    + [table_value(table, name, i) for name in table])
+                writer.addFeature(out_f, QgsFeatureSink.FastInsert)
+            del writer
+
+    def cell_ratios(self, grid, binner, ratio_field, ratio):
+        # коэффициент по ячейкам из поля сетки; пустые и неположительные значения - общий коэффициент
+        if not ratio_field:
+            return ratio
+        values = np.full(len(binner), ratio)
+        req = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        req.setSubsetOfAttributes([ratio_field], grid.fields())
+        for f in grid.getFeatures(req):
+            i = binner.position.get(f.id())
+            val = f[ratio_field]
+            if i is not None and val is not None and float(val) > 0:
+                values[i] = float(val)
+        return values
+
+    def report_summary(self, table, feedback):
+        # итоги по сценариям: в журнал и в выход SUMMARY
+        summary = deficit_summary(table)
+        for name, totals in summary.items():
+            feedback.pushInfo(f"{name}: дефицит {int(totals['shortage'])} мест в {totals['cells_short']} ячейках, "
+                              f"баланс {int(totals['net'])}")
+        return json.dumps(summary, ensure_ascii=False)
+
+    def run_incremental(self, parameters, context, feedback, profiler, target_layer, parking_field, pop_field,
+                        ratio, scenarios, ratio_field, weighted):
+        # обновление готового слоя дефицита: пересчитываются только ячейки,
+        # затронутые добавленными, измененными и удаленными объектами с прошлого прогона
+        state_path = DeficitState.path_for(target_layer)
+        if not state_path:
+            raise QgsProcessingException("Инкрементальный режим работает только со слоем в файле (GeoPackage, Shapefile)")
+        provider = target_layer.dataProvider()
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues:
+            raise QgsProcessingException("Слой дефицита нельзя редактировать")
+
+        sum_names = {'parking': parking_field + '_sum', 'pop': pop_field + '_sum'}
+        missing = [QgsField(name, QVariant.Double) for name in sum_names.values()
+                   if target_layer.fields().indexOf(name) < 0]
+        for name in ['Deficit'] + [name for name, _ in scenarios]:
+            if target_layer.fields().indexOf(name) < 0:
+                missing.append(QgsField(name, QVariant.Int, len=10))
+        if missing:
+            provider.addAttributes(missing)
+            target_layer.updateFields()
+
+        # ячейки берутся из самого обновляемого слоя; их индекс хранится на диске
+        # и после записи дефицита переписывается с новым штампом файла
+        grid_key = [crs_key(target_layer.crs())]
+        grid_sidecar = None if target_layer.isModified() else IndexSidecar.for_layer(target_layer, 'grid', grid_key)
+        with profiler.stage("Разметка ячеек сетки") as record:
+            binner = GridBinner(target_layer, feedback, grid_sidecar)
+            record['features'] = len(binner)
+        meta = {'version': DeficitState.VERSION, 'parking_field': parking_field, 'pop_field': pop_field,
+                'crs': binner.crs.authid(), 'weighted': weighted, 'ratio': ratio,
+                'scenarios': [r for _, r in scenarios], 'ratio_field': ratio_field, 'stamps': {}}
+        state = DeficitState.load(state_path)
+        full = (state is None or not np.array_equal(state.cell_fids, binner.fids)
+                or any(state.meta.get(k) != meta[k] for k in ('parking_field', 'pop_field', 'crs', 'weighted')))
+        if full:
+            feedback.pushInfo("Состояние прошлого прогона не найдено или устарело: полный пересчет слоя")
+            state = DeficitState(state_path, meta, binner.fids)
+        # смена коэффициентов или поле коэффициента (его правки не отслеживаются) - дефицит пишется во все ячейки
+        recompute_all = full or ratio_field or any(state.meta.get(k) != meta[k] for k in ('ratio', 'scenarios', 'ratio_field'))
+        affected = [np.arange(len(binner))] if recompute_all else []
+
+        sources = {'parking': (self.parameterAsSource(parameters, self.INPUT_PARKING, context), parking_field,
+                               self.whole_layer(parameters, self.INPUT_PARKING, context)),
+                   'pop': (self.parameterAsSource(parameters, self.INPUT_BUILDINGS, context), pop_field,
+                           self.whole_layer(parameters, self.INPUT_BUILDINGS, context))}
+        totals = {}
+        for key, (source, field, layer) in sources.items():
+            arrays = state.arrays[key]
+            stamp = layer_stamp(layer) if layer is not None else None
+            meta['stamps'][key] = stamp
+            edited = edit_buffer_fids(layer)
+            if not full and stamp is not None and state.meta.get('stamps', {}).get(key) == stamp:
+                # файл слоя не менялся с прошлого прогона: изменения есть только в буфере правок -
+                # текущие и прошлого прогона (те могли быть отменены)
+                changed = np.union1d(arrays['buffer_fids'], edited)
+                dirty = changed
+                # подписи правленых объектов устарели - при полной проверке они считаются измененными
+                keep = ~np.isin(arrays['sig_fids'], changed)
+                arrays['sig_fids'], arrays['sigs'] = arrays['sig_fids'][keep], arrays['sigs'][keep]
+                feedback.pushInfo(f"{field}: по буферу правок затронуто {len(changed)} объектов")
+            else:
+                with profiler.stage(f"Подписи объектов ({field})") as record:
+                    sig_fids, sigs = feature_signatures(source, field, feedback)
+                    record['features'] = len(sig_fids)
+
+                # новые и измененные объекты - по подписи, удаленные - по отсутствию в слое;
+                # правки прошлого прогона из буфера (временные id новых объектов) пересчитываются всегда
+                old_sigs = dict(zip(arrays['sig_fids'].tolist(), arrays['sigs'].tolist()))
+                changed = np.fromiter((fid for fid, sig in zip(sig_fids.tolist(), sigs.tolist())
+                                       if old_sigs.get(fid) != sig), dtype=np.int64)
+                removed = np.setdiff1d(arrays['sig_fids'], sig_fids)
+                feedback.pushInfo(f"{field}: изменено {len(changed)}, удалено {len(removed)} объектов")
+                changed = np.union1d(changed, arrays['buffer_fids'])
+                dirty = np.concatenate([changed, removed])
+                arrays['sig_fids'], arrays['sigs'] = sig_fids, sigs
+            arrays['buffer_fids'] = edited
+
+            stale = np.isin(arrays['pair_fids'], dirty)
+            affected.append(arrays['pair_cells'][stale])
+            with profiler.stage(f"Привязка измененных объектов ({field})") as record:
+                fids, cells, values = binner.pairs(source, field, context, None, changed, weighted)
+                record['features'] = len(changed)
+            affected.append(cells)
+            arrays['pair_fids'] = np.concatenate([arrays['pair_fids'][~stale], fids])
+            arrays['pair_cells'] = np.concatenate([arrays['pair_cells'][~stale], cells])
+            arrays['pair_values'] = np.concatenate([arrays['pair_values'][~stale], values])
+            totals[key] = binner.totals(arrays['pair_cells'], arrays['pair_values'])
+
+        if feedback.isCanceled():
+            return {}
+
+        # в слой пишутся только затронутые ячейки
+        affected = np.unique(np.concatenate(affected)) if affected else np.empty(0, dtype=np.int64)
+        (parking_sum, parking_hits), (pop_sum, pop_hits) = totals['parking'], totals['pop']
+        table = deficit_table(parking_sum, parking_hits, pop_sum, pop_hits,
+                              self.cell_ratios(target_layer, binner, ratio_field, ratio), scenarios)
+        idx_parking = target_layer.fields().indexOf(sum_names['parking'])
+        idx_pop = target_layer.fields().indexOf(sum_names['pop'])
+        idx_table = {name: target_layer.fields().indexOf(name) for name in table}
+        changes = {}
+        for i in affected.tolist():
+            values = {idx_parking: float(parking_sum[i]) if parking_hits[i] else None,
+                      idx_pop: float(pop_sum[i]) if pop_hits[i] else None}
+            for name, idx in idx_table.items():
+                values[idx] = table_value(table, name, i)
+            changes[binner.fids[i]] = values
+        with profiler.stage("Запись измененных ячеек") as record:
+            if changes and not provider.changeAttributeValues(changes):
+                raise QgsProcessingException("Не удалось записать дефицит в слой")
+            record['features'] = len(changes)
+        target_layer.triggerRepaint()
+        if grid_sidecar and changes:
+            IndexSidecar.for_layer(target_layer, 'grid', grid_key).save(binner.arrays())
+
+        state.meta = meta
+        state.save()
+        feedback.pushInfo(f"Обновлено ячеек: {len(changes)} из {len(binner)}")
+        return {self.OUTPUT_LAYER: target_layer.id(), self.SUMMARY: self.report_summary(table, feedback)}
+
+    def run_joins(self, parameters, context, feedback, profiler, parking_field, pop_field, ratio, scenarios, ratio_field):
+        # исходный способ: два пространственных соединения и калькулятор полей
         parking_sum_field_name = parking_field + '_sum'
         pop_sum_field_name = pop_field + '_sum'
 
 
         feedback.pushInfo(f"Расчет суммы парковочных мест ({parking_field})")
         
-        parking_sum_result = processing.run("native:joinattributesbylocation", {
+        parking_sum_result = profiler.run("native:joinattributesbylocation", {
             'INPUT': parameters[self.INPUT_GRID],
             'JOIN': parameters[self.INPUT_PARKING],
             'PREDICATE': [0],
@@ -97,14 +1197,14 @@ class ParkingDeficitAnalyzer(QgsProcessingAlgorithm):
             'SUM_FIELDS': [parking_field],
             'SUMMARY_FIELDS': [2],
             'OUTPUT': 'memory:'
-        }, context=context, feedback=feedback, is_child_algorithm=True)
+        }, context, feedback)
         
         temp_layer_parking = parking_sum_result['OUTPUT']
 
 
         feedback.pushInfo(f"Расчет суммы жителей ({pop_field})")
         
-        pop_sum_result = processing.run("native:joinattributesbylocation", {
+        pop_sum_result = profiler.run("native:joinattributesbylocation", {
             'INPUT': temp_layer_parking,
             'JOIN': parameters[self.INPUT_BUILDINGS],
             'PREDICATE': [0],
@@ -112,26 +1212,48 @@ class ParkingDeficitAnalyzer(QgsProcessingAlgorithm):
             'SUM_FIELDS': [pop_field],
             'SUMMARY_FIELDS': [2],
             'OUTPUT': 'memory:'
-        }, context=context, feedback=feedback, is_child_algorithm=True)
+        }, context, feedback)
         
         temp_layer_final = pop_sum_result['OUTPUT']
 
 
         feedback.pushInfo("Расчет дефицита")
         
-        formula = f' ("{pop_sum_field_name}" / {ratio}) - "{parking_sum_field_name}" '
-
-        deficit_calc_result = processing.run("native:fieldcalculator", {
-            'INPUT': temp_layer_final,
-            'FIELD_NAME': 'Deficit',
-            'FIELD_TYPE': 1, # (Целое число)
-            'FIELD_LENGTH': 10,
-            'FIELD_PRECISION': 0,
-            'FORMULA': formula,
-            'OUTPUT': parameters[self.OUTPUT_LAYER]
-        }, context=context, feedback=feedback, is_child_algorithm=True)
-
-        return {self.OUTPUT_LAYER: deficit_calc_result['OUTPUT']}
+        # основной дефицит и сценарии - по одному калькулятору полей на поле, соединения общие
+        # как в быстром способе: пустые и неположительные значения поля - общий коэффициент
+        ratio_expr = (f'CASE WHEN "{ratio_field}" > 0 THEN "{ratio_field}" ELSE {ratio} END'
+                      if ratio_field else f'{ratio}')
+        columns = [('Deficit', ratio_expr)] + [(name, f'{r}') for name, r in scenarios]
+        for n, (name, expr) in enumerate(columns):
+            formula = f' ("{pop_sum_field_name}" / {expr}) - "{parking_sum_field_name}" '
+
+            deficit_calc_result = profiler.run("native:fieldcalculator", {
+                'INPUT': temp_layer_final,
+                'FIELD_NAME': name,
+                'FIELD_TYPE': 1, # (Целое число)
+                'FIELD_LENGTH': 10,
+                'FIELD_PRECISION': 0,
+                'FORMULA': formula,
+                'OUTPUT': parameters[self.OUTPUT_LAYER] if n == len(columns) - 1 else 'memory:'
+            }, context, feedback)
+            temp_layer_final = deficit_calc_result['OUTPUT']
+
+        # итоги по сценариям - по записанному слою
+        output = deficit_calc_result['OUTPUT']
+        with profiler.stage("Итоги по сценариям") as record:
+            layer = QgsProcessingUtils.mapLayerFromString(output, context) if isinstance(output, str) else output
+            names = [name for name, _ in columns]
+            values = {name: array('d') for name in names}
+            req = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+            req.setSubsetOfAttributes(names, layer.fields())
+            for f in layer.getFeatures(req):
+                for name in names:
+                    # NULL - нет парковок или жителей
+                    val = f[name]
+                    values[name].append(float(val) if isinstance(val, (int, float)) else np.nan)
+            table = {name: np.frombuffer(values[name], dtype=float) for name in names}
+            record['features'] = layer.featureCount()
+        return {self.OUTPUT_LAYER: output, self.SUMMARY: self.report_summary(table, feedback)}
 
     def tr(self, message):
         return QgsProcessingAlgorithm.tr(self, message)
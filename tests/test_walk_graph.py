@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# проверки пешеходного графа task1/main1.py; нужен python с qgis
+
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('qgis.core')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(path):
+    # скрипты обработки самостоятельны - загружаются по пути, как их загружает qgis
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+main1 = load_script(os.path.join(ROOT, 'task1', 'main1.py'))
+
+
+def test_snap_to_nearest_long_edge():
+    # длинная улица в 5 м от остановки и десять коротких отрезков в 35 м:
+    # ближайшие узлы - у коротких отрезков, но привязка должна быть к улице
+    node_x = [0.0, 2000.0] + [950.0 + 10 * i for i in range(11)]
+    node_y = [0.0, 0.0] + [40.0] * 11
+    edge_u = np.array([0] + list(range(2, 12)))
+    edge_v = np.array([1] + list(range(3, 13)))
+    graph = main1.WalkGraph(np.array(node_x), np.array(node_y), edge_u, edge_v,
+                            np.array([2000.0] + [10.0] * 10))
+    nodes, costs, snap_edges, snap_t = graph.snap_points(np.array([1000.0]), np.array([5.0]))
+    assert snap_edges.tolist() == [0]
+    assert snap_t[0] == pytest.approx(0.5)
+    assert nodes.tolist() == [0, 1]
+    assert costs.tolist() == pytest.approx([1000.0, 1000.0])